@@ -0,0 +1,442 @@
+#! /usr/bin/env python
+#
+#  Copyright (c) 2015 Chris Johns <chrisj@rtems.org>. All rights reserved.
+#
+#  Copyright (c) 2009-2015 embedded brains GmbH.  All rights reserved.
+#
+#   embedded brains GmbH
+#   Dornierstr. 4
+#   82178 Puchheim
+#   Germany
+#   <info@embedded-brains.de>
+#
+#  Copyright (c) 2012 OAR Corporation. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#  1. Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+#  "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+#  LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+#  A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+#  OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+#  SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+#  LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+#  DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+#  THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#  (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Benchmarks for the FreeBSD to RTEMS conversion tooling.
+#
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import getopt
+import platform
+import tempfile
+import subprocess
+
+import builder
+import makefile
+import waf_generator
+import ninja_generator
+import libbsd
+
+#
+# The chain of substitutions the include rewriter replaced. It is the
+# reference for the output and the speed of the single pass rewriter.
+#
+def chainFixIncludes(data):
+    data = re.sub('#include <sys/lock.h>', '#include <rtems/bsd/sys/lock.h>', data)
+    data = re.sub('#include <sys/time.h>', '#include <rtems/bsd/sys/time.h>', data)
+    data = re.sub('#include <sys/cpuset.h>', '#include <rtems/bsd/sys/cpuset.h>', data)
+    data = re.sub('#include <sys/errno.h>', '#include <rtems/bsd/sys/errno.h>', data)
+    data = re.sub('#include <sys/param.h>', '#include <rtems/bsd/sys/param.h>', data)
+    data = re.sub('#include <sys/types.h>', '#include <rtems/bsd/sys/types.h>', data)
+    data = re.sub('#include <sys/resource.h>', '#include <rtems/bsd/sys/resource.h>', data)
+    data = re.sub('#include <sys/unistd.h>', '#include <rtems/bsd/sys/unistd.h>', data)
+    data = re.sub('#include <sys/_types.h>', '#include <rtems/bsd/sys/_types.h>', data)
+    return data
+
+def chainRevertFixIncludes(data):
+    data = re.sub('#include <rtems/bsd/', '#include <', data)
+    data = re.sub('#include <util.h>', '#include <rtems/bsd/util.h>', data)
+    data = re.sub('#include <bsd.h>', '#include <rtems/bsd/bsd.h>', data)
+    data = re.sub('#include <zerocopy.h>', '#include <rtems/bsd/zerocopy.h>', data)
+    return data
+
+def chainFixLocalIncludes(data):
+    data = re.sub('#include "opt_([^"]*)"', '#include <rtems/bsd/local/opt_\\1>', data)
+    data = re.sub('#include "([^"]*)_if.h"', '#include <rtems/bsd/local/\\1_if.h>', data)
+    data = re.sub('#include "miidevs([^"]*)"', '#include <rtems/bsd/local/miidevs\\1>', data)
+    data = re.sub('#include "usbdevs([^"]*)"', '#include <rtems/bsd/local/usbdevs\\1>', data)
+    return data
+
+def chainRevertFixLocalIncludes(data):
+    data = re.sub('#include <rtems/bsd/local/([^>]*)>', '#include "\\1"', data)
+    return data
+
+def chainForward(data):
+    return chainFixIncludes(chainFixLocalIncludes(data))
+
+def chainReverse(data):
+    data = re.sub('#include <machine/rtems-bsd-kernel-space.h>\n\n', '', data)
+    data = re.sub('#include <machine/rtems-bsd-user-space.h>\n\n', '', data)
+    return chainRevertFixIncludes(chainRevertFixLocalIncludes(data))
+
+def rewriterForward(data):
+    return builder._fixAllIncludes.rewrite(data)
+
+def rewriterReverse(data):
+    return builder._revertFixSourceIncludes.rewrite(data)
+
+def readSources(paths):
+    sources = []
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith('.c') or name.endswith('.h'):
+                    sources += [open(os.path.join(root, name)).read()]
+    return sources
+
+def timeConversion(convert, sources, repeat):
+    best = None
+    for r in range(0, repeat):
+        start = time.time()
+        for data in sources:
+            convert(data)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def benchmarkIncludes(paths, repeat):
+    sources = readSources(paths)
+    size = sum([len(data) for data in sources])
+    if size == 0:
+        print 'error: no C sources or headers found'
+        sys.exit(2)
+    mb = size / (1024.0 * 1024.0)
+    print 'Include rewriting of %d file(s), %.1f MB, best of %d' % (len(sources), mb, repeat)
+    for name, chain, rewriter in [('forward', chainForward, rewriterForward),
+                                  ('reverse', chainReverse, rewriterReverse)]:
+        for data in sources:
+            if chain(data) != rewriter(data):
+                print 'error: %s rewriter output differs from the chain' % (name)
+                sys.exit(1)
+        chainTime = timeConversion(chain, sources, repeat)
+        rewriterTime = timeConversion(rewriter, sources, repeat)
+        print '  %s chain:    %8.1f MB/s' % (name, mb / chainTime)
+        print '  %s rewriter: %8.1f MB/s (%.1fx)' % (name, mb / rewriterTime,
+                                                     chainTime / rewriterTime)
+
+#
+# Synthetic FreeBSD like source tree and module manifest. Each module has 100
+# upstream files: kernel and user space sources and headers, files copied as
+# is and CPU dependent sources shared by several target CPUs.
+#
+syntheticTargetCPUs = ['arm', 'powerpc', 'sparc']
+
+def syntheticSource(index, lines):
+    data = '/*\n * Synthetic source %d.\n */\n\n' % (index)
+    data += '#include <sys/param.h>\n' \
+            '#include <sys/types.h>\n' \
+            '#include <sys/lock.h>\n' \
+            '#include "opt_inet.h"\n' \
+            '#include "bus_if.h"\n' \
+            '#include <net/if.h>\n\n'
+    for line in range(0, lines):
+        data += 'static int value_%d_%d = %d; /* padding to a realistic size */\n' % \
+                (index, line, line)
+    return data
+
+def syntheticModule(mm, number):
+    mod = builder.Module('synthetic%04d' % (number))
+    ksrc = ['sys/m%04d/k%03d.c' % (number, i) for i in range(0, 38)]
+    khdr = ['sys/m%04d/k%03d.h' % (number, i) for i in range(0, 20)]
+    usrc = ['lib/m%04d/u%03d.c' % (number, i) for i in range(0, 20)]
+    uhdr = ['lib/m%04d/u%03d.h' % (number, i) for i in range(0, 10)]
+    copy = ['usr.sbin/m%04d/c%03d.y' % (number, i) for i in range(0, 10)]
+    cpu = ['sys/mips/mips/m%04d_%d.c' % (number, i) for i in range(0, 2)]
+    mod.addKernelSpaceSourceFiles(ksrc, mm.generator['source']())
+    mod.addKernelSpaceHeaderFiles(khdr)
+    mod.addUserSpaceSourceFiles(usrc, mm.generator['source'](['-DSYNTHETIC=%d' % (number % 4)]))
+    mod.addUserSpaceHeaderFiles(uhdr)
+    for path in copy:
+        mod.addFile(mm.generator['file'](path,
+                                         mm.generator['freebsd-path'](),
+                                         mm.generator['convert'](),
+                                         mm.generator['convert'](),
+                                         builder.BuildSystemFragmentComposer()))
+    mod.addTargetSourceCPUDependentSourceFiles(syntheticTargetCPUs, 'mips', cpu,
+                                               mm.generator['source']())
+    return mod, ksrc + khdr + usrc + uhdr + copy + cpu
+
+def syntheticSources(mm, count):
+    paths = []
+    for number in range(0, max(1, count // 100)):
+        mod, modPaths = syntheticModule(mm, number)
+        mm.addModule(mod)
+        paths += modPaths
+    mod = builder.Module('tests')
+    mod.addTest(mm.generator['test']('synthetic01', ['test_main']))
+    mm.addModule(mod)
+    return paths
+
+def syntheticTree(root, paths, lines):
+    for index, path in enumerate(paths):
+        path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        out = open(path, 'w')
+        out.write(syntheticSource(index, lines))
+        out.close()
+
+def timePhase(name, results, phase):
+    builder.filesProcessed = 0
+    start = time.time()
+    phase()
+    elapsed = time.time() - start
+    results[name] = { 'seconds': elapsed, 'changed': builder.filesProcessed }
+    print '  %-20s %9.3f s %8d changed' % (name, elapsed, builder.filesProcessed)
+
+def benchmarkSync(count, lines, keep):
+    root = tempfile.mkdtemp(prefix = 'libbsd-benchmark-')
+    freebsd = os.path.join(root, 'freebsd-org')
+    rtems = os.path.join(root, 'rtems-libbsd')
+    os.makedirs(rtems)
+    results = {}
+    stdout = sys.stdout
+    try:
+        builder.FreeBSD_DIR = freebsd
+        builder.RTEMS_DIR = rtems
+        builder.isDiffMode = False
+        mm = builder.ModuleManager()
+        paths = syntheticSources(mm, count)
+        syntheticTree(freebsd, paths, lines)
+        files = len(mm.getFiles())
+        print 'Sync of %d upstream file(s), %d file(s) in %d module(s), %d job(s), %d I/O thread(s)' % \
+            (len(paths), files, len(mm.getModules()), builder.jobs, builder.ioThreads)
+        generators = [makefile.Generator(mm),
+                      waf_generator.Generator(mm),
+                      ninja_generator.Generator(mm)]
+
+        # Like freebsd-to-rtems.py the files are staged and committed
+        # unless diffing
+        def _sync(cache):
+            if cache:
+                builder.loadSyncCache()
+            else:
+                builder.syncCache = None
+            if not builder.isDiffMode:
+                builder.beginStaging()
+            try:
+                mm.copyFromFreeBSDToRTEMS()
+                builder.commitStaging()
+            finally:
+                builder.staging = None
+            builder.saveSyncCache()
+
+        def _diff():
+            for path in paths[::100]:
+                out = open(os.path.join(freebsd, path), 'a')
+                out.write('/* changed */\n')
+                out.close()
+            builder.isDiffMode = True
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                _sync(True)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+                builder.isDiffMode = False
+
+        def _reverse():
+            builder.loadSyncCache()
+            builder.copyPlanned(builder.plannedCopies(mm.getFiles(),
+                                                      'getFromRTEMSToFreeBSD'))
+            builder.saveSyncCache()
+
+        def _generate():
+            for generator in generators:
+                generator.run()
+
+        timePhase('cold-sync', results, lambda: _sync(True))
+        timePhase('warm-sync', results, lambda: _sync(True))
+        timePhase('warm-sync-no-cache', results, lambda: _sync(False))
+        timePhase('diff', results, _diff)
+        timePhase('reverse-sync', results, _reverse)
+        timePhase('generate', results, _generate)
+    finally:
+        sys.stdout = stdout
+        builder.syncCache = None
+        if keep:
+            print 'Kept ' + root
+        else:
+            shutil.rmtree(root)
+    return { 'upstream-files': len(paths),
+             'files': files,
+             'lines-per-file': lines,
+             'jobs': builder.jobs,
+             'io-threads': builder.ioThreads,
+             'phases': results }
+
+#
+# Reproducible generation - the build system files generated from the modules
+# must be the same for every hash seed of the interpreter, otherwise a
+# regeneration without a change of the modules rebuilds everything. Each seed
+# generates the files in a separate interpreter.
+#
+generatedFiles = ['Makefile', 'wscript', 'build.ninja']
+
+def generateInto(path):
+    builder.RTEMS_DIR = path
+    mm = builder.ModuleManager()
+    libbsd.sources(mm)
+    for generator in [makefile.Generator(mm),
+                      waf_generator.Generator(mm),
+                      ninja_generator.Generator(mm)]:
+        generator.run()
+
+def benchmarkReproducible(seeds):
+    root = tempfile.mkdtemp(prefix = 'libbsd-reproducible-')
+    script = os.path.abspath(__file__)
+    reference = None
+    differs = False
+    print 'Generation of %s with %d hash seed(s)' % (', '.join(generatedFiles), len(seeds))
+    try:
+        for seed in seeds:
+            path = os.path.join(root, 'seed-' + seed)
+            os.makedirs(path)
+            env = dict(os.environ)
+            env['PYTHONHASHSEED'] = seed
+            devnull = open(os.devnull, 'w')
+            start = time.time()
+            try:
+                status = subprocess.call([sys.executable, script, 'generate', path],
+                                         cwd = os.path.dirname(script),
+                                         env = env, stdout = devnull)
+            finally:
+                devnull.close()
+            elapsed = time.time() - start
+            if status != 0:
+                print 'error: generation with hash seed %s failed' % (seed)
+                sys.exit(1)
+            files = {}
+            for name in generatedFiles:
+                files[name] = open(os.path.join(path, name), 'rb').read()
+            if reference is None:
+                reference = files
+            changed = [name for name in generatedFiles if files[name] != reference[name]]
+            if len(changed) > 0:
+                differs = True
+                result = 'differs: ' + ', '.join(changed)
+            else:
+                result = 'same'
+            print '  seed %-12s %9.3f s %s' % (seed, elapsed, result)
+    finally:
+        shutil.rmtree(root)
+    if differs:
+        print 'error: the generated files depend on the hash seed'
+        sys.exit(1)
+
+def usage():
+    print "benchmark.py [args] includes [path ...]"
+    print "benchmark.py [args] sync [count ...]"
+    print "benchmark.py [args] reproducible [seed ...]"
+    print "  -?|-h|--help     print this and exit"
+    print "  -n|--repeat N    repeat each measurement N times (default: 3)"
+    print "  -j|--jobs N      process files with N parallel jobs (default: 1)"
+    print "  -t|--io-threads N"
+    print "                   overlap the file I/O with N reader and writer threads"
+    print "                   (default: 0)"
+    print "  -l|--lines N     lines per synthetic file (default: 100)"
+    print "  -k|--keep        keep the synthetic trees"
+    print "  -o|--output FILE write the results as JSON to FILE"
+    print "benchmarks:"
+    print "  includes         include rewriting of the C files under the paths"
+    print "                   (default: freebsd)"
+    print "  sync             cold, warm, diff and reverse sync and the generation"
+    print "                   of synthetic trees with count files (default: 1000)"
+    print "  reproducible     generate the Makefile, waf script and Ninja file of the"
+    print "                   modules with each hash seed and fail if they differ"
+    print "                   (default: 0 1 2 3 4294967295)"
+
+def main():
+    repeat = 3
+    lines = 100
+    keep = False
+    output = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "?hn:j:t:l:ko:",
+                                   [ "help", "repeat=", "jobs=", "io-threads=", "lines=",
+                                     "keep", "output=" ])
+    except getopt.GetoptError, err:
+        print str(err)
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o in ("-h", "--help", "-?"):
+            usage()
+            sys.exit()
+        elif o in ("-n", "--repeat"):
+            repeat = int(a)
+        elif o in ("-j", "--jobs"):
+            builder.jobs = int(a)
+        elif o in ("-t", "--io-threads"):
+            builder.ioThreads = int(a)
+        elif o in ("-l", "--lines"):
+            lines = int(a)
+        elif o in ("-k", "--keep"):
+            keep = True
+        elif o in ("-o", "--output"):
+            output = a
+    if len(args) == 0:
+        usage()
+        sys.exit(2)
+    if args[0] == 'includes':
+        paths = args[1:]
+        if len(paths) == 0:
+            paths = ['freebsd']
+        benchmarkIncludes(paths, repeat)
+    elif args[0] == 'sync':
+        counts = [int(count) for count in args[1:]]
+        if len(counts) == 0:
+            counts = [1000]
+        runs = [benchmarkSync(count, lines, keep) for count in counts]
+        if output is not None:
+            report = { 'benchmark': 'sync',
+                       'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'converters': builder.converterIdentity(),
+                       'runs': runs }
+            out = open(output, 'w')
+            json.dump(report, out, indent = 1, sort_keys = True)
+            out.close()
+    elif args[0] == 'reproducible':
+        seeds = args[1:]
+        if len(seeds) == 0:
+            seeds = ['0', '1', '2', '3', '4294967295']
+        benchmarkReproducible(seeds)
+    elif args[0] == 'generate' and len(args) == 2:
+        generateInto(args[1])
+    else:
+        print 'error: unknown benchmark: ' + args[0]
+        usage()
+        sys.exit(2)
+
+if __name__ == "__main__":
+    main()
@@ -36,11 +36,21 @@
 
 import shutil
 import os
+import errno
 import re
 import sys
 import getopt
 import filecmp
 import difflib
+import hashlib
+import json
+import multiprocessing
+import StringIO
+import subprocess
+import tempfile
+import threading
+import time
+import Queue
 
 #
 # Global controls.
@@ -51,10 +61,30 @@ isVerbose = False
 isDryRun = False
 isDiffMode = False
 filesProcessed = 0
+jobs = 1
+ioThreads = 0
+ioDepth = 64
+syncCache = None
+syncCacheName = '.libbsd-sync-cache'
+staging = None
+stagingName = '.libbsd-staging'
+sourceStore = None
+conversionCache = None
+profiler = None
+diffLimit = 1024 * 1024
+diffOutput = None
+diffStat = None
+currentModule = None
+
+#
+# Copy jobs handed to the process pool. The pool is created after this is set
+# so the forked workers inherit the jobs and the global controls.
+#
+_poolJobs = []
 
 class error(Exception):
     """Base class for exceptions."""
-    def __init(self, msg):
+    def __init__(self, msg):
         self.msg = 'error: %s' % (msg)
     def set_output(self, msg):
         self.msg = msg
@@ -99,6 +129,12 @@ def cpu_includes():
     return ['-Irtemsbsd/@CPU@/include',
             '-Ifreebsd/sys/@CPU@/include']
 
+# the CPU ports of RTEMS, a BSP of any of them may build the library
+def rtems_cpus():
+    return ['arm', 'avr', 'bfin', 'epiphany', 'h8300', 'i386', 'lm32',
+            'm32c', 'm32r', 'm68k', 'mips', 'moxie', 'nios2', 'no_cpu',
+            'or1k', 'powerpc', 'sh', 'sparc', 'sparc64', 'v850']
+
 def cflags():
     return ['-std=gnu11']
 
@@ -127,67 +163,1321 @@ def header_paths():
             ('mDNSResponder/mDNSShared',      'dns_sd.h',          ''),
             ('mDNSResponder/mDNSPosix',       'mDNSPosix.h',       '')]
 
-# compare and process file only if different
-#  + copy or diff depending on execution mode
-def processIfDifferent(new, old, src):
+#
+# Profiler - collects the wall time, bytes and counts per stage, per module
+# and per source file. The time of a stage excludes the time of the stages
+# started within it.
+#
+class Profiler(object):
+    def __init__(self):
+        self.began = time.time()
+        self.module = None
+        self.stack = []
+        self.stages = {}
+        self.modules = {}
+        self.files = {}
+
+    def _add(self, stages, stage, seconds, bytesIn, bytesOut):
+        if stage not in stages:
+            stages[stage] = { 'calls': 0, 'seconds': 0.0,
+                              'bytes-in': 0, 'bytes-out': 0 }
+        s = stages[stage]
+        s['calls'] += 1
+        s['seconds'] += seconds
+        s['bytes-in'] += bytesIn
+        s['bytes-out'] += bytesOut
+
+    def start(self, stage):
+        self.stack.append([stage, time.time(), 0.0])
+
+    def stop(self, bytesIn = 0, bytesOut = 0):
+        stage, begin, nested = self.stack.pop()
+        elapsed = time.time() - begin
+        if len(self.stack) > 0:
+            self.stack[-1][2] += elapsed
+        self._add(self.stages, stage, elapsed - nested, bytesIn, bytesOut)
+        if self.module is not None:
+            self._add(self.modules.setdefault(self.module, {}),
+                      stage, elapsed - nested, bytesIn, bytesOut)
+        return elapsed
+
+    def addFile(self, path, seconds):
+        self.files[path] = self.files.get(path, 0.0) + seconds
+
+    def getData(self):
+        return { 'seconds': time.time() - self.began,
+                 'stages': self.stages,
+                 'modules': self.modules,
+                 'files': self.files }
+
+    def merge(self, data):
+        for stage, s in data['stages'].items():
+            self._merge(self.stages, stage, s)
+        for module, stages in data['modules'].items():
+            for stage, s in stages.items():
+                self._merge(self.modules.setdefault(module, {}), stage, s)
+        for path, seconds in data['files'].items():
+            self.addFile(path, seconds)
+
+    def _merge(self, stages, stage, s):
+        self._add(stages, stage, s['seconds'], s['bytes-in'], s['bytes-out'])
+        stages[stage]['calls'] += s['calls'] - 1
+
+    def slowest(self, count):
+        files = sorted(self.files.items(), key = lambda f: (-f[1], f[0]))
+        return files[:count]
+
+    def report(self, count = 10):
+        def _stages(indent, stages):
+            for stage in sorted(stages):
+                s = stages[stage]
+                print '%s%-52s %6d %9.3f %11d %11d' % \
+                    (indent, stage, s['calls'], s['seconds'], s['bytes-in'], s['bytes-out'])
+        print 'Profile: %.3f seconds' % (time.time() - self.began)
+        print '  %-52s %6s %9s %11s %11s' % ('stage', 'calls', 'seconds', 'bytes in', 'bytes out')
+        _stages('  ', self.stages)
+        for module in sorted(self.modules):
+            print '  module ' + module + ':'
+            _stages('    ', self.modules[module])
+        print '  slowest files:'
+        for path, seconds in self.slowest(count):
+            print '    %9.3f %s' % (seconds, path)
+
+    def save(self, path, count = 10):
+        data = self.getData()
+        data['slowest'] = self.slowest(count)
+        out = open(path, 'w')
+        try:
+            json.dump(data, out, indent = 1, sort_keys = True)
+        finally:
+            out.close()
+
+def profileStart(stage):
+    if profiler is not None:
+        profiler.start(stage)
+
+def profileStop(bytesIn = 0, bytesOut = 0):
+    if profiler is not None:
+        return profiler.stop(bytesIn, bytesOut)
+    return 0.0
+
+# compare the data with a file's contents streaming the file
+def isSameData(data, path):
+    try:
+        if os.stat(path).st_size != len(data):
+            return False
+    except OSError:
+        return False
+    f = open(path, 'rb')
+    try:
+        offset = 0
+        while True:
+            block = f.read(65536)
+            if len(block) == 0:
+                return offset == len(data)
+            if block != data[offset:offset + len(block)]:
+                return False
+            offset += len(block)
+    finally:
+        f.close()
+
+# The umask of the process. It can only be read by setting it, this is done
+# once here and not while the writer threads create files.
+_umask = os.umask(0)
+os.umask(_umask)
+
+# create a temporary file next to the path, fill it with the writer and
+# rename it over the path so the file is replaced atomically
+#  + during a staged sync the file is renamed to its place in the staging
+#    area and replaces the path when the sync is committed
+def _replaceFile(path, writer):
+    try:
+        mode = os.stat(path).st_mode & 0777
+    except OSError:
+        mode = 0666 & ~_umask
+    if staging is not None:
+        path = staging.stage(path)
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path) or '.',
+                               prefix = '.' + os.path.basename(path) + '.')
+    try:
+        out = os.fdopen(fd, 'wb')
+        try:
+            writer(out)
+        finally:
+            out.close()
+        os.chmod(tmp, mode)
+        os.rename(tmp, path)
+    except:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+# write the data to the path atomically
+def writeFile(path, data):
+    _replaceFile(path, lambda out: out.write(data))
+
+# copy a file to the path atomically without reading it into memory
+def copyFile(src, path):
+    def _copy(out):
+        f = open(src, 'rb')
+        try:
+            shutil.copyfileobj(f, out, 65536)
+        finally:
+            f.close()
+    _replaceFile(path, _copy)
+
+#
+# Diff Stat - the lines inserted and deleted per module and file in diff mode.
+#
+class DiffStat(object):
+    def __init__(self):
+        self.modules = {}
+
+    def add(self, module, path, insertions, deletions, notice = None):
+        if module is None:
+            module = 'none'
+        self.modules.setdefault(module, []).append((path, insertions, deletions, notice))
+
+    def getData(self):
+        return self.modules
+
+    def merge(self, data):
+        for module, files in data.items():
+            self.modules.setdefault(module, []).extend(files)
+
+    def report(self):
+        for module in sorted(self.modules):
+            files = self.modules[module]
+            insertions = sum([f[1] for f in files])
+            deletions = sum([f[2] for f in files])
+            print 'Module %s: %d file(s) changed, %d insertion(s)(+), %d deletion(s)(-)' % \
+                (module, len(files), insertions, deletions)
+            for path, insertions, deletions, notice in files:
+                if notice is not None:
+                    print '  %s | %s' % (path, notice)
+                else:
+                    print '  %s | %d +%d -%d' % (path, insertions + deletions,
+                                                 insertions, deletions)
+
+# write diff output to the diff output file or stdout
+def _diffWrite(text):
+    if diffOutput is not None:
+        diffOutput.write(text)
+    else:
+        sys.stdout.write(text)
+
+# the reason a file is not diffed, binary or too large, or None
+def _diffNotice(data, old):
+    size = len(data)
+    head = ''
+    if os.path.exists(old):
+        size = max(size, os.path.getsize(old))
+        f = open(old, 'rb')
+        try:
+            head = f.read(8192)
+        finally:
+            f.close()
+    if '\0' in data[:8192] or '\0' in head:
+        return 'binary'
+    if diffLimit > 0 and size > diffLimit:
+        return 'too large'
+    return None
+
+# write the unified diff of the old file and the new data
+def diffData(data, old, src):
+    notice = _diffNotice(data, old)
+    insertions = 0
+    deletions = 0
+    if notice is not None:
+        _diffWrite('Files %s and %s differ (%s)\n' % (src, old, notice))
+    else:
+        if os.path.exists(old):
+            old_contents = open(old).readlines()
+        else:
+            old_contents = []
+        new_contents = data.splitlines(True)
+        lines = []
+        for line in \
+            difflib.unified_diff(old_contents, new_contents,
+                                 fromfile = src, tofile = old, n = 5):
+            if line[0] == '+' and not line.startswith('+++'):
+                insertions += 1
+            elif line[0] == '-' and not line.startswith('---'):
+                deletions += 1
+            lines += [line]
+        _diffWrite(''.join(lines))
+    if diffStat is not None:
+        diffStat.add(currentModule, old, insertions, deletions, notice)
+
+# compare the data with the old file and process it only if different
+#  + write or diff depending on execution mode
+#  + returns True if the old file now has the new contents
+def processDataIfDifferent(data, old, src):
 
     global filesProcessed
     global isVerbose, isDryRun, isEarlyExit
 
-    if not os.path.exists(old) or \
-       filecmp.cmp(new, old, shallow = False) == False:
+    profileStart('compare')
+    same = isSameData(data, old)
+    profileStop(len(data))
+    if not same:
         filesProcessed += 1
         if isDiffMode == False:
             if isVerbose == True:
                 print "Move " + src + " to " + old
             if isDryRun == False:
-                shutil.move(new, old)
+                profileStart('write')
+                writeFile(old, data)
+                profileStop(0, len(data))
+                return True
         else:
             if isVerbose == True:
-                print "Diff %s => %s" % (src, new)
-            old_contents = open(old).readlines()
-            new_contents = open(new).readlines()
-            for line in \
-                difflib.unified_diff(old_contents, new_contents,
-                                     fromfile = src, tofile = new, n = 5):
-                sys.stdout.write(line)
+                print "Diff %s => %s" % (src, old)
+            profileStart('diff')
+            diffData(data, old, src)
+            profileStop(len(data))
+        return False
+    return True
+
+# compare and process file only if different
+#  + copy or diff depending on execution mode
+#  + returns True if the old file now has the new contents
+def processIfDifferent(new, old, src):
+
+    global filesProcessed
+
+    profileStart('compare')
+    same = os.path.exists(old) and filecmp.cmp(new, old, shallow = False)
+    profileStop(os.path.getsize(new))
+    if same:
+        return True
+    if isDiffMode:
+        return processDataIfDifferent(open(new, 'rb').read(), old, src)
+    filesProcessed += 1
+    if isVerbose == True:
+        print "Move " + src + " to " + old
+    if isDryRun == False:
+        profileStart('write')
+        copyFile(new, old)
+        profileStop(0, os.path.getsize(new))
+        return True
+    return False
+
+# the paths relative to the FreeBSD directory changed since a git revision,
+# up to the revision of the source store if the sources are read from git
+def changedFromGit(rev):
+    if sourceStore is not None:
+        command = ['git', 'diff', '--name-only', rev, sourceStore.commit, '--']
+    else:
+        command = ['git', 'diff', '--name-only', '--relative', rev, '--']
+    try:
+        git = subprocess.Popen(command,
+                               cwd = FreeBSD_DIR,
+                               stdout = subprocess.PIPE,
+                               stderr = subprocess.PIPE)
+    except OSError, ose:
+        raise error('git: %s' % (ose))
+    out, err = git.communicate()
+    if git.returncode != 0:
+        raise error('git diff %s: %s' % (rev, err.strip()))
+    return out.splitlines()
+
+# the paths relative to the FreeBSD directory listed in a file, one per line
+def changedFromList(path):
+    paths = []
+    for line in open(path):
+        line = line.strip()
+        if len(line) > 0 and line[0] != '#':
+            paths += [line]
+    return paths
+
+# the FreeBSD files and directories a Makefile uses, relative to the FreeBSD
+# directory
+#  + a variable set to the FreeBSD directory names the files after it
+#  + a variable set to a directory in the FreeBSD directory names all files
+#    of the directory, e.g. the interface generation tools
+def makefileFreeBSDPaths(makefile, freebsdDir = 'freebsd-org'):
+    files = set()
+    dirs = set()
+    data = open(makefile).read()
+    for name, value in re.findall(r'^(\w+)\s*=\s*(\S+)\s*$', data, re.MULTILINE):
+        value = os.path.normpath(value)
+        if value == freebsdDir:
+            for path in re.findall(r'\$\(' + name + r'\)/([^\s:;]+)', data):
+                files.add(os.path.normpath(path))
+        elif value.startswith(freebsdDir + os.sep):
+            dirs.add(value[len(freebsdDir) + 1:])
+    return sorted(files), sorted(dirs)
+
+# git sparse-checkout patterns for files and directories relative to the
+# FreeBSD directory
+def sparseCheckoutPatterns(files, dirs):
+    patterns = ['/' + d.strip('/') + '/' for d in dirs]
+    patterns += ['/' + f for f in files
+                 if not [d for d in dirs if f.startswith(d.strip('/') + '/')]]
+    return sorted(patterns)
+
+# The identity of the conversion code. A change to this module invalidates
+# every conversion recorded in a sync cache.
+def converterIdentity():
+    path = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    return hashlib.sha1(open(path, 'rb').read()).hexdigest()
+
+# the names of the converter classes of a copy and of the copy in the other
+# direction, the sync cache and staging journal entries record both
+def _converterNames(converter):
+    return [converter.__class__.__name__, converter.counterpart.__class__.__name__]
+
+def _fileState(path, digest = None):
+    if _isStored(path):
+        return sourceStore.state(path)
+    st = os.stat(path)
+    if digest is None:
+        digest = hashlib.sha1(open(path, 'rb').read()).hexdigest()
+    return [st.st_size, st.st_mtime, digest]
+
+# the size and modification time of a file or the size and object of a file
+# read from git
+def _fileStamp(path):
+    if _isStored(path):
+        return sourceStore.state(path)[:2]
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+#
+# Git Source Store - reads the FreeBSD files of a revision from the object
+# store of the git repository in the FreeBSD directory, no checkout needed.
+# The objects and sizes of all files of the revision are listed by one git
+# ls-tree and the files are read through one git cat-file --batch process.
+# A forked pool worker starts its own process.
+#
+class GitSourceStore(object):
+    def __init__(self, repo, rev):
+        self.repo = repo
+        self.rev = rev
+        self.prefix = os.path.normpath(repo) + os.sep
+        self.lock = threading.Lock()
+        self.process = None
+        self.pid = None
+        self.blobs = {}
+        self.commit = self._git(['rev-parse', '--verify', rev + '^{commit}']).strip()
+        for entry in self._git(['ls-tree', '-r', '-l', '-z', self.commit]).split('\0'):
+            if len(entry) == 0:
+                continue
+            info, path = entry.split('\t', 1)
+            mode, kind, obj, size = info.split()
+            if kind == 'blob':
+                self.blobs[path] = (obj, int(size))
+
+    def _git(self, args):
+        try:
+            git = subprocess.Popen(['git'] + args,
+                                   cwd = self.repo,
+                                   stdout = subprocess.PIPE,
+                                   stderr = subprocess.PIPE)
+        except OSError, ose:
+            raise error('git: %s' % (ose))
+        out, err = git.communicate()
+        if git.returncode != 0:
+            raise error('git %s %s: %s' % (args[0], self.rev, err.strip()))
+        return out
+
+    def _relative(self, path):
+        path = os.path.normpath(path)
+        if path.startswith(self.prefix):
+            return path[len(self.prefix):]
+        return None
+
+    def owns(self, path):
+        return self._relative(path) is not None
+
+    def _blob(self, path):
+        blob = self.blobs.get(self._relative(path))
+        if blob is None:
+            raise IOError(errno.ENOENT, 'No such file in %s' % (self.rev), path)
+        return blob
+
+    def state(self, path):
+        obj, size = self._blob(path)
+        return [size, obj, obj]
+
+    def read(self, path):
+        obj, size = self._blob(path)
+        self.lock.acquire()
+        try:
+            if self.pid != os.getpid():
+                self.process = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                                cwd = self.repo,
+                                                stdin = subprocess.PIPE,
+                                                stdout = subprocess.PIPE)
+                self.pid = os.getpid()
+            self.process.stdin.write(obj + '\n')
+            self.process.stdin.flush()
+            header = self.process.stdout.readline().split()
+            if len(header) != 3 or header[1] != 'blob':
+                raise error('git cat-file %s: %s' % (obj, ' '.join(header)))
+            data = self.process.stdout.read(int(header[2]))
+            self.process.stdout.read(1)
+            return data
+        finally:
+            self.lock.release()
+
+    def close(self):
+        if self.process is not None and self.pid == os.getpid():
+            self.process.stdin.close()
+            self.process.wait()
+        self.process = None
+
+def openSourceStore(rev):
+    global sourceStore
+    sourceStore = GitSourceStore(FreeBSD_DIR, rev)
+
+def closeSourceStore():
+    global sourceStore
+    if sourceStore is not None:
+        sourceStore.close()
+    sourceStore = None
+
+def _isStored(path):
+    return sourceStore is not None and sourceStore.owns(path)
+
+# read a source file from the source store or the file system
+def readSource(path):
+    if _isStored(path):
+        return sourceStore.read(path)
+    return open(path).read()
+
+#
+# Conversion Cache - keeps the outputs of the converters in files named by
+# the hash of the converter, the conversion code and the source contents so
+# the same source is converted once even across RTEMS directories. The least
+# recently used outputs are removed to keep the cache below a size limit.
+#
+class ConversionCache(object):
+    def __init__(self, path, limit):
+        self.path = path
+        self.limit = limit
+        self.identity = converterIdentity()
+        self.hits = 0
+        self.misses = 0
+
+    # the file of a conversion, a file read from git is identified by its
+    # object without reading it
+    def _path(self, converter, src, data):
+        if data is None:
+            source = 'git:' + sourceStore.state(src)[2]
+        else:
+            source = hashlib.sha1(data).hexdigest()
+        key = hashlib.sha1('\0'.join([converter.__class__.__name__,
+                                      self.identity, source])).hexdigest()
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, converter, src, data = None):
+        path = self._path(converter, src, data)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+        try:
+            out = f.read()
+        finally:
+            f.close()
+        # Mark the output as recently used for trim(), a dry run leaves the
+        # cache untouched and a cache of another user may not be writable
+        if not isDryRun:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        self.hits += 1
+        return out
+
+    def put(self, converter, src, data, out):
+        path = self._path(converter, src, data)
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path), prefix = '.')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(out)
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        except:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    # remove the least recently used outputs until the cache fits the limit
+    def trim(self):
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries += [(st.st_mtime, path, st.st_size)]
+                total += st.st_size
+        removed = 0
+        for mtime, path, size in sorted(entries):
+            if total <= self.limit:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def report(self):
+        print 'Conversion cache: %d hit(s), %d miss(es)' % (self.hits, self.misses)
+
+def openConversionCache(path, limit):
+    global conversionCache
+    conversionCache = ConversionCache(path, limit)
+
+def closeConversionCache():
+    global conversionCache
+    if conversionCache is not None and not isDryRun:
+        conversionCache.trim()
+    conversionCache = None
+
+# convert a source looking up and storing the output in the conversion
+# cache, a dry run only looks up
+def convertSource(converter, src, data = None):
+    if conversionCache is None:
+        return converter.convert(src, data)
+    if data is None and not _isStored(src):
+        try:
+            data = readSource(src)
+        except IOError:
+            # Left to the converter to report or ignore
+            return converter.convert(src)
+    out = conversionCache.get(converter, src, data)
+    if out is None:
+        out = converter.convert(src, data)
+        if not isDryRun:
+            conversionCache.put(converter, src, data, out)
+    return out
+
+#
+# Sync Cache - records the state of the source and destination of each
+# converted file so a later sync can skip files whose inputs did not change.
+#
+class SyncCache(object):
+    version = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.identity = converterIdentity()
+        self.entries = {}
+        self.updates = {}
+        try:
+            cache = json.load(open(path))
+            if cache['version'] == self.version and \
+               cache['converters'] == self.identity:
+                self.entries = cache['files']
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+
+    def _key(self, src, dst):
+        return src + ' -> ' + dst
+
+    def _isSame(self, path, state):
+        if _isStored(path):
+            return sourceStore.state(path) == state
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_size != state[0]:
+            return False
+        if st.st_mtime == state[1]:
+            return True
+        # Touched but maybe not modified, e.g. by a checkout
+        if _fileState(path)[2] != state[2]:
+            return False
+        state[1] = st.st_mtime
+        return True
+
+    # A copy is current if both files are as recorded by the last copy in
+    # this direction or, e.g. for a reverse sync after a forward sync, by the
+    # last copy in the other direction.
+    # The converters of both directions must be those of the recorded copy.
+    def isCurrent(self, src, dst, converter):
+        converters = _converterNames(converter)
+        key = self._key(src, dst)
+        entry = self.entries.get(key)
+        if entry is not None and entry['converters'] == converters and \
+           self._isSame(src, entry['src']) and self._isSame(dst, entry['dst']):
+            self.updates[key] = entry
+            return True
+        key = self._key(dst, src)
+        entry = self.entries.get(key)
+        if entry is not None and entry['converters'] == converters[::-1] and \
+           self._isSame(dst, entry['src']) and self._isSame(src, entry['dst']):
+            self.updates[key] = entry
+            return True
+        return False
+
+    def update(self, src, dst, converter, data = None):
+        if data is not None:
+            digest = hashlib.sha1(data).hexdigest()
+        else:
+            digest = None
+        self.updateDigest(src, dst, _converterNames(converter), digest)
+
+    def updateDigest(self, src, dst, converters, digest = None):
+        key = self._key(src, dst)
+        entry = { 'converters': converters,
+                  'src': _fileState(src),
+                  'dst': _fileState(dst, digest) }
+        self.entries[key] = entry
+        self.updates[key] = entry
+
+    def merge(self, updates):
+        self.entries.update(updates)
+        self.updates.update(updates)
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        out = open(tmp, 'w')
+        try:
+            json.dump({ 'version': self.version,
+                        'converters': self.identity,
+                        'files': self.entries },
+                      out, indent = 1, sort_keys = True)
+        finally:
+            out.close()
+        os.rename(tmp, self.path)
+
+def loadSyncCache():
+    global syncCache
+    syncCache = SyncCache(os.path.join(RTEMS_DIR, syncCacheName))
+
+def saveSyncCache():
+    if syncCache is not None and not isDryRun and len(syncCache.updates) > 0:
+        syncCache.save()
+
+#
+# Staging - the files written by a sync are placed in a staging area and a
+# journal records every destination brought up to date. The staged files
+# replace the destinations when the sync is committed. An interrupted sync
+# leaves the tree untouched and may be resumed from the journal.
+#
+class Staging(object):
+    def __init__(self, path, resume = False):
+        self.path = path
+        self.journal = os.path.join(path, 'journal')
+        self.done = {}
+        self.records = []
+        self.staged = {}
+        self.lock = threading.Lock()
+        if resume and os.path.exists(self.journal):
+            for line in open(self.journal):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of an interrupted sync may be incomplete
+                    continue
+                if 'converters' not in record:
+                    # Written by an older version, the file is copied again
+                    continue
+                self.done[self._key(record['src'], record['dst'])] = record
+                self.records += [record]
+        elif os.path.exists(path):
+            shutil.rmtree(path)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.out = open(self.journal, 'a')
+
+    def _key(self, src, dst):
+        return src + ' -> ' + dst
+
+    def _stagedPath(self, dst):
+        return os.path.join(self.path, hashlib.sha1(dst).hexdigest())
+
+    def _append(self, records):
+        self.lock.acquire()
+        try:
+            for record in records:
+                self.records += [record]
+                if self.out is not None:
+                    self.out.write(json.dumps(record, sort_keys = True) + '\n')
+            if self.out is not None:
+                self.out.flush()
+        finally:
+            self.lock.release()
+
+    # the path in the staging area a destination is written to
+    def stage(self, dst):
+        self.staged[dst] = self._stagedPath(dst)
+        return self.staged[dst]
+
+    # a destination is done if a resumed journal has it for the same source
+    # and converters
+    def isDone(self, src, dst, converter):
+        record = self.done.get(self._key(src, dst))
+        if record is None or record.get('converters') != _converterNames(converter):
+            return False
+        try:
+            if _fileStamp(src) != record['state']:
+                return False
+        except (IOError, OSError):
+            return False
+        return not record['staged'] or os.path.exists(self._stagedPath(dst))
+
+    def record(self, src, dst, converter, data = None):
+        if data is not None:
+            digest = hashlib.sha1(data).hexdigest()
+        else:
+            digest = None
+        self._append([{ 'src': src,
+                        'dst': dst,
+                        'converters': _converterNames(converter),
+                        'state': _fileStamp(src),
+                        'staged': dst in self.staged,
+                        'digest': digest }])
+
+    def merge(self, records):
+        self._append(records)
+
+    def getResumed(self):
+        return len(self.done)
+
+    # move the staged files to their destinations with renames, update the
+    # sync cache and remove the staging area, returns the files moved which
+    # the interrupted sync staged, the files of this sync are counted already
+    def commit(self):
+        self.out.close()
+        self.out = None
+        latest = {}
+        order = []
+        for record in self.records:
+            if record['dst'] not in latest:
+                order += [record['dst']]
+            latest[record['dst']] = record
+        resumed = 0
+        for dst in order:
+            record = latest[dst]
+            staged = self._stagedPath(dst)
+            if record['staged'] and os.path.exists(staged):
+                try:
+                    os.makedirs(os.path.dirname(dst))
+                except OSError:
+                    pass
+                os.rename(staged, dst)
+                if record is self.done.get(self._key(record['src'], dst)):
+                    resumed += 1
+            if syncCache is not None and os.path.exists(dst):
+                syncCache.updateDigest(record['src'], dst,
+                                       record['converters'], record['digest'])
+        shutil.rmtree(self.path)
+        return resumed
+
+def beginStaging(resume = False):
+    global staging
+    staging = Staging(os.path.join(RTEMS_DIR, stagingName), resume)
+
+def commitStaging():
+    global staging
+    if staging is None:
+        return 0
+    profileStart('commit')
+    try:
+        resumed = staging.commit()
+    finally:
+        profileStop()
+    staging = None
+    return resumed
+
+# the destinations of a source which need a copy
+def _pendingDestinations(src, dsts, converter):
+    if syncCache is not None:
+        dsts = [dst for dst in dsts if not syncCache.isCurrent(src, dst, converter)]
+    if staging is not None:
+        dsts = [dst for dst in dsts if not staging.isDone(src, dst, converter)]
+    return dsts
+
+# record a destination which has the new contents in the staging journal or
+# the sync cache
+def _copied(src, dst, converter, data = None):
+    if staging is not None:
+        staging.record(src, dst, converter, data)
+    elif syncCache is not None:
+        syncCache.update(src, dst, converter, data)
+
+# copy a source to one or more destinations converting it only once
+#  + 'checked' destinations are known to need a copy, the sync cache and the
+#    staging journal are not asked again
+def copyToAll(src, dsts, converter, module = None, checked = False):
+    global currentModule
+    if converter is None or not converter.isConvertible():
+        return
+    currentModule = module
+    if profiler is not None:
+        profiler.module = module
+    profileStart('copy')
+    try:
+        _copyToAll(src, dsts, converter, checked)
+    finally:
+        elapsed = profileStop()
+        if profiler is not None:
+            profiler.addFile(src, elapsed)
+
+def _copyToAll(src, dsts, converter, checked = False):
+    if not checked and (syncCache is not None or staging is not None):
+        profileStart('cache')
+        dsts = _pendingDestinations(src, dsts, converter)
+        profileStop()
+        if len(dsts) == 0:
+            return
+    if converter.isIdentity() and not _isStored(src):
+        data = None
+    else:
+        profileStart('convert:' + converter.__class__.__name__)
+        data = convertSource(converter, src)
+        profileStop(0, len(data))
+    for dst in dsts:
+        try:
+            if isDryRun == False:
+                os.makedirs(os.path.dirname(dst))
+        except OSError:
+            pass
+        if data is None:
+            upToDate = processIfDifferent(src, dst, src)
+        else:
+            upToDate = processDataIfDifferent(data, dst, src)
+        if upToDate and (syncCache is not None or staging is not None):
+            profileStart('cache')
+            _copied(src, dst, converter, data)
+            profileStop()
+
+# group the copies of the files by source and converter so a source shared
+# by several files, e.g. for different target CPUs, is converted once
+#  + 'method' is the File method returning the source, destination and
+#    converter of the direction
+def copyJobs(files, method):
+    work = []
+    groups = {}
+    for f in files:
+        src, dst, converter = getattr(f, method)()
+        if converter is None or not converter.isConvertible():
+            continue
+        key = (src, converter.__class__)
+        if key not in groups:
+            groups[key] = (src, [], converter, f.module)
+            work += [groups[key]]
+        if dst not in groups[key][1]:
+            groups[key][1].append(dst)
+    return work
+
+# the copies of the files with work to do, the changed sources are converted
+# and compared but nothing is written
+#  + each copy is (src, dst, converter, module, data, changed), the data is
+#    kept for copyPlanned() and is None for an identity conversion and for a
+#    destination which is up to date
+def plannedCopies(files, method):
+    planned = []
+    for src, dsts, converter, module in copyJobs(files, method):
+        dsts = _pendingDestinations(src, dsts, converter)
+        if len(dsts) == 0:
+            continue
+        if converter.isIdentity():
+            for dst in dsts:
+                changed = not os.path.exists(dst) or \
+                          not filecmp.cmp(src, dst, shallow = False)
+                planned += [(src, dst, converter, module, None, changed)]
+        else:
+            profileStart('convert:' + converter.__class__.__name__)
+            data = convertSource(converter, src)
+            profileStop(0, len(data))
+            for dst in dsts:
+                if isSameData(data, dst):
+                    planned += [(src, dst, converter, module, None, False)]
+                else:
+                    planned += [(src, dst, converter, module, data, True)]
+    return planned
+
+# write the changed destinations of planned copies without converting the
+# sources again
+def copyPlanned(planned):
+    global filesProcessed, currentModule
+    for src, dst, converter, module, data, changed in planned:
+        currentModule = module
+        if changed:
+            filesProcessed += 1
+            if isVerbose == True:
+                print "Move " + src + " to " + dst
+            if isDryRun == True:
+                continue
+            try:
+                os.makedirs(os.path.dirname(dst))
+            except OSError:
+                pass
+            profileStart('write')
+            if data is None:
+                copyFile(src, dst)
+                profileStop(0, os.path.getsize(src))
+            else:
+                writeFile(dst, data)
+                profileStop(0, len(data))
+        if syncCache is not None or staging is not None:
+            profileStart('cache')
+            _copied(src, dst, converter, data)
+            profileStop()
+
+# process a copy job in a pool worker capturing the count, the output and
+# the cache, profile and diff stat data
+def _poolCopy(index):
+    global filesProcessed, profiler, diffOutput, diffStat
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    filesProcessed = 0
+    result = {}
+    if syncCache is not None:
+        syncCache.updates = {}
+    if staging is not None:
+        staging.out = None
+        staging.records = []
+    if conversionCache is not None:
+        conversionCache.hits = 0
+        conversionCache.misses = 0
+    if profiler is not None:
+        profiler = Profiler()
+    if diffOutput is not None:
+        diffOutput = StringIO.StringIO()
+    if diffStat is not None:
+        diffStat = DiffStat()
+    try:
+        copyToAll(*_poolJobs[index], checked = True)
+        result['processed'] = filesProcessed
+        result['output'] = sys.stdout.getvalue()
+        if syncCache is not None:
+            result['cache'] = syncCache.updates
+        if staging is not None:
+            result['staging'] = staging.records
+        if conversionCache is not None:
+            result['conversions'] = (conversionCache.hits, conversionCache.misses)
+        if profiler is not None:
+            result['profile'] = profiler.getData()
+        if diffOutput is not None:
+            result['diff'] = diffOutput.getvalue()
+        if diffStat is not None:
+            result['diffstat'] = diffStat.getData()
+        return result
+    finally:
+        sys.stdout = stdout
+
+#
+# Sync Pipeline - overlaps reading the sources, converting them and writing
+# the destinations. Reader threads check the sync cache and read the source
+# and the destinations ahead, the data is converted and compared in the order
+# of the files and writer threads replace the destinations. At most 'depth'
+# files are in flight so the memory used does not grow with the manifest.
+#
+class SyncPipeline(object):
+    def __init__(self, work, threads, depth):
+        self.work = work
+        self.threads = threads
+        self.slots = threading.Semaphore(depth)
+        self.reads = Queue.Queue()
+        self.prepared = Queue.Queue()
+        self.writes = Queue.Queue(depth)
+        self.stopped = False
+        self.failure = None
+
+    def _start(self, target):
+        thread = threading.Thread(target = target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _feed(self):
+        for index in range(len(self.work)):
+            self.slots.acquire()
+            if self.stopped:
+                break
+            self.reads.put(index)
+        for thread in range(self.threads):
+            self.reads.put(None)
+
+    def _prepare(self, job):
+        src, dsts, converter, module = job
+        dsts = _pendingDestinations(src, dsts, converter)
+        record = { 'dsts': dsts, 'data': None, 'olds': [] }
+        if len(dsts) == 0:
+            return record
+        if converter.isIdentity() and not _isStored(src):
+            for dst in dsts:
+                record['olds'] += [os.path.exists(dst) and \
+                                   filecmp.cmp(src, dst, shallow = False)]
+            return record
+        try:
+            record['data'] = readSource(src)
+        except IOError:
+            # Left to the converter to report or ignore
+            pass
+        for dst in dsts:
+            try:
+                record['olds'] += [open(dst, 'rb').read()]
+            except IOError:
+                record['olds'] += [None]
+        return record
+
+    def _read(self):
+        while True:
+            index = self.reads.get()
+            if index is None:
+                return
+            try:
+                self.prepared.put((index, self._prepare(self.work[index]), None))
+            except:
+                self.prepared.put((index, None, sys.exc_info()))
+
+    def _write(self):
+        while True:
+            item = self.writes.get()
+            if item is None:
+                return
+            if self.failure is not None:
+                continue
+            src, dst, converter, data = item
+            try:
+                try:
+                    os.makedirs(os.path.dirname(dst))
+                except OSError:
+                    pass
+                if data is None:
+                    copyFile(src, dst)
+                else:
+                    writeFile(dst, data)
+                _copied(src, dst, converter, data)
+            except:
+                if self.failure is None:
+                    self.failure = sys.exc_info()
+
+    def _copy(self, index, pending):
+        global filesProcessed, currentModule
+        src, dsts, converter, module = self.work[index]
+        currentModule = module
+        if profiler is not None:
+            profiler.module = module
+        profileStart('read')
+        while index not in pending:
+            prepared, record, failure = self.prepared.get()
+            pending[prepared] = (record, failure)
+        profileStop()
+        record, failure = pending.pop(index)
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
+        data = record['data']
+        identity = converter.isIdentity() and not _isStored(src)
+        if not identity and len(record['dsts']) > 0:
+            profileStart('convert:' + converter.__class__.__name__)
+            data = convertSource(converter, src, data)
+            profileStop(0, len(data))
+        for dst, old in zip(record['dsts'], record['olds']):
+            if identity:
+                same = old
+            else:
+                same = old == data
+            if same:
+                profileStart('cache')
+                _copied(src, dst, converter, data)
+                profileStop()
+                continue
+            filesProcessed += 1
+            if isDiffMode:
+                if isVerbose == True:
+                    print "Diff %s => %s" % (src, dst)
+                profileStart('diff')
+                if data is None:
+                    diffData(open(src, 'rb').read(), dst, src)
+                else:
+                    diffData(data, dst, src)
+                profileStop()
+            else:
+                if isVerbose == True:
+                    print "Move " + src + " to " + dst
+                if isDryRun == False:
+                    profileStart('write')
+                    self.writes.put((src, dst, converter, data))
+                    profileStop()
+
+    def run(self):
+        self._start(self._feed)
+        for thread in range(self.threads):
+            self._start(self._read)
+        writers = [self._start(self._write) for thread in range(self.threads)]
+        pending = {}
+        try:
+            for index in range(len(self.work)):
+                if self.failure is not None:
+                    break
+                profileStart('copy')
+                try:
+                    self._copy(index, pending)
+                finally:
+                    elapsed = profileStop()
+                    if profiler is not None:
+                        profiler.addFile(self.work[index][0], elapsed)
+                self.slots.release()
+        finally:
+            self.stopped = True
+            self.slots.release()
+            for writer in writers:
+                self.writes.put(None)
+            profileStart('write')
+            for writer in writers:
+                writer.join()
+            profileStop()
+        if self.failure is not None:
+            raise self.failure[0], self.failure[1], self.failure[2]
+
+# copy the files in order, through a pipeline of 'ioThreads' reader and
+# writer threads or fan them out to a pool of 'jobs' processes
+#  + the sync cache and the staging journal are checked before the pool is
+#    started so only the copies with work to do are sent to the workers
+#  + the counts and output are merged in the order of the files
+def copyFiles(files, method):
+    global filesProcessed, _poolJobs
+    work = copyJobs(files, method)
+    if jobs < 2 and ioThreads > 0:
+        SyncPipeline(work, ioThreads, ioDepth).run()
+        return
+    if jobs < 2 or len(work) < 2:
+        for job in work:
+            copyToAll(*job)
+        return
+    pending = []
+    profileStart('cache')
+    for src, dsts, converter, module in work:
+        dsts = _pendingDestinations(src, dsts, converter)
+        if len(dsts) > 0:
+            pending += [(src, dsts, converter, module)]
+    profileStop()
+    if len(pending) < 2:
+        for job in pending:
+            copyToAll(*job, checked = True)
+        return
+    _poolJobs = pending
+    pool = multiprocessing.Pool(min(jobs, len(pending)))
+    chunksize = max(8, len(pending) // (jobs * 4))
+    try:
+        for result in pool.imap(_poolCopy, range(len(pending)), chunksize):
+            filesProcessed += result['processed']
+            sys.stdout.write(result['output'])
+            if 'cache' in result:
+                syncCache.merge(result['cache'])
+            if 'staging' in result:
+                staging.merge(result['staging'])
+            if 'conversions' in result:
+                conversionCache.hits += result['conversions'][0]
+                conversionCache.misses += result['conversions'][1]
+            if 'profile' in result:
+                profiler.merge(result['profile'])
+            if 'diff' in result:
+                diffOutput.write(result['diff'])
+            if 'diffstat' in result:
+                diffStat.merge(result['diffstat'])
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        _poolJobs = []
 
 # Move target dependent files under a machine directory
 def mapCPUDependentPath(path):
   return path.replace("include/", "include/machine/")
 
+#
+# Include Rewriter - applies a table of include rewrite rules in a single pass.
+#
+# Each rule is a pattern matched after '#include ' and the replacement for the
+# whole include. All rules are combined into one regular expression and at a
+# given include the first matching rule wins, like in a chain of substitutions
+# where no rule matches the output of an earlier rule.
+#
+class IncludeRewriter(object):
+    def __init__(self, rules):
+        self.rules = [(re.compile(pattern), repl) for pattern, repl in rules]
+        alternatives = ['(?P<r%d>%s)' % (i, rule[0]) for i, rule in enumerate(rules)]
+        self.regex = re.compile('#include (?:' + '|'.join(alternatives) + ')')
+
+    def _replace(self, match):
+        name = match.lastgroup
+        rule, repl = self.rules[int(name[1:])]
+        return rule.match(match.group(name)).expand(repl)
+
+    def rewrite(self, data):
+        return self.regex.sub(self._replace, data)
+
+def _fixIncludesRules():
+    headers = ['lock', 'time', 'cpuset', 'errno', 'param', 'types',
+               'resource', 'unistd', '_types']
+    return [('<sys/(' + '|'.join(headers) + r')\.h>',
+             r'#include <rtems/bsd/sys/\1.h>')]
+
+def _revertFixIncludesRules():
+    headers = '(util|bsd|zerocopy)'
+    return [('<rtems/bsd/' + headers + r'\.h>', r'#include <rtems/bsd/\1.h>'),
+            ('<rtems/bsd/',                    r'#include <'),
+            ('<' + headers + r'\.h>',          r'#include <rtems/bsd/\1.h>')]
+
+def _fixLocalIncludesRules():
+    return [(r'"opt_([^"]*)"',     r'#include <rtems/bsd/local/opt_\1>'),
+            (r'"([^"]*)_if\.h"',   r'#include <rtems/bsd/local/\1_if.h>'),
+            (r'"miidevs([^"]*)"',  r'#include <rtems/bsd/local/miidevs\1>'),
+            (r'"usbdevs([^"]*)"',  r'#include <rtems/bsd/local/usbdevs\1>')]
+
+def _revertFixLocalIncludesRules():
+    return [(r'<rtems/bsd/local/([^>]*)>', r'#include "\1"')]
+
+def _revertSpaceIncludesRules():
+    return [(r'<machine/rtems-bsd-(kernel|user)-space\.h>\n\n', '')]
+
+_fixIncludes = IncludeRewriter(_fixIncludesRules())
+_revertFixIncludes = IncludeRewriter(_revertFixIncludesRules())
+_fixLocalIncludes = IncludeRewriter(_fixLocalIncludesRules())
+_revertFixLocalIncludes = IncludeRewriter(_revertFixLocalIncludesRules())
+_fixAllIncludes = IncludeRewriter(_fixLocalIncludesRules() + _fixIncludesRules())
+_revertFixAllIncludes = IncludeRewriter(_revertFixLocalIncludesRules() +
+                                        _revertFixIncludesRules())
+_revertFixSourceIncludes = IncludeRewriter(_revertSpaceIncludesRules() +
+                                           _revertFixLocalIncludesRules() +
+                                           _revertFixIncludesRules())
+
+# fix the system include paths inside a C or .h file
 def fixIncludes(data):
-    data = re.sub('#include <sys/lock.h>', '#include <rtems/bsd/sys/lock.h>', data)
-    data = re.sub('#include <sys/time.h>', '#include <rtems/bsd/sys/time.h>', data)
-    data = re.sub('#include <sys/cpuset.h>', '#include <rtems/bsd/sys/cpuset.h>', data)
-    data = re.sub('#include <sys/errno.h>', '#include <rtems/bsd/sys/errno.h>', data)
-    data = re.sub('#include <sys/param.h>', '#include <rtems/bsd/sys/param.h>', data)
-    data = re.sub('#include <sys/types.h>', '#include <rtems/bsd/sys/types.h>', data)
-    data = re.sub('#include <sys/resource.h>', '#include <rtems/bsd/sys/resource.h>', data)
-    data = re.sub('#include <sys/unistd.h>', '#include <rtems/bsd/sys/unistd.h>', data)
-    data = re.sub('#include <sys/_types.h>', '#include <rtems/bsd/sys/_types.h>', data)
-    return data
+    return _fixIncludes.rewrite(data)
 
 # revert fixing the include paths inside a C or .h file
 def revertFixIncludes(data):
-    data = re.sub('#include <rtems/bsd/', '#include <', data)
-    data = re.sub('#include <util.h>', '#include <rtems/bsd/util.h>', data)
-    data = re.sub('#include <bsd.h>', '#include <rtems/bsd/bsd.h>', data)
-    data = re.sub('#include <zerocopy.h>', '#include <rtems/bsd/zerocopy.h>', data)
-    return data
+    return _revertFixIncludes.rewrite(data)
 
 # fix include paths inside a C or .h file
 def fixLocalIncludes(data):
-    data = re.sub('#include "opt_([^"]*)"', '#include <rtems/bsd/local/opt_\\1>', data)
-    data = re.sub('#include "([^"]*)_if.h"', '#include <rtems/bsd/local/\\1_if.h>', data)
-    data = re.sub('#include "miidevs([^"]*)"', '#include <rtems/bsd/local/miidevs\\1>', data)
-    data = re.sub('#include "usbdevs([^"]*)"', '#include <rtems/bsd/local/usbdevs\\1>', data)
-    return data
+    return _fixLocalIncludes.rewrite(data)
 
 # revert fixing the include paths inside a C or .h file
 def revertFixLocalIncludes(data):
-    data = re.sub('#include <rtems/bsd/local/([^>]*)>', '#include "\\1"', data)
-    return data
+    return _revertFixLocalIncludes.rewrite(data)
 
 def assertHeaderFile(path):
     if path[-2] != '.' or path[-1] != 'h':
@@ -202,65 +1492,72 @@ def assertSourceFile(path):
         sys.exit(2)
 
 class Converter(object):
-    def convert(self, src):
-        return open(src).read()
+    # The converter of the other direction, see File
+    counterpart = None
+
+    # The data of the source may have been read in advance.
+    def convert(self, src, data = None):
+        if data is None:
+            profileStart('read')
+            data = readSource(src)
+            profileStop(len(data))
+        return data
 
     def isConvertible(self):
         return True
 
+    # The base converter copies the file as is. A file with an identity
+    # conversion is compared and copied without reading it into memory.
+    def isIdentity(self):
+        return self.__class__ is Converter
+
 class NoConverter(Converter):
-    def convert(self, src):
+    def convert(self, src, data = None):
         raise
 
     def isConvertible(self):
         return False
 
 class EmptyConverter(Converter):
-    def convert(self, src):
+    def convert(self, src, data = None):
         return '/* EMPTY */\n'
 
 class FromFreeBSDToRTEMSHeaderConverter(Converter):
-    def convert(self, src):
-        data = super(FromFreeBSDToRTEMSHeaderConverter, self).convert(src)
-        data = fixLocalIncludes(data)
-        data = fixIncludes(data)
+    def convert(self, src, data = None):
+        data = super(FromFreeBSDToRTEMSHeaderConverter, self).convert(src, data)
+        data = _fixAllIncludes.rewrite(data)
         return data
 
 class FromFreeBSDToRTEMSUserSpaceHeaderConverter(Converter):
-    def convert(self, src):
-        data = super(FromFreeBSDToRTEMSUserSpaceHeaderConverter, self).convert(src)
+    def convert(self, src, data = None):
+        data = super(FromFreeBSDToRTEMSUserSpaceHeaderConverter, self).convert(src, data)
         data = fixIncludes(data)
         return data
 
 class FromFreeBSDToRTEMSSourceConverter(Converter):
-    def convert(self, src):
-        data = super(FromFreeBSDToRTEMSSourceConverter, self).convert(src)
-        data = fixLocalIncludes(data)
-        data = fixIncludes(data)
+    def convert(self, src, data = None):
+        data = super(FromFreeBSDToRTEMSSourceConverter, self).convert(src, data)
+        data = _fixAllIncludes.rewrite(data)
         data = '#include <machine/rtems-bsd-kernel-space.h>\n\n' + data
         return data
 
 class FromFreeBSDToRTEMSUserSpaceSourceConverter(Converter):
-    def convert(self, src):
-        data = super(FromFreeBSDToRTEMSUserSpaceSourceConverter, self).convert(src)
+    def convert(self, src, data = None):
+        data = super(FromFreeBSDToRTEMSUserSpaceSourceConverter, self).convert(src, data)
         data = fixIncludes(data)
         data = '#include <machine/rtems-bsd-user-space.h>\n\n' + data
         return data
 
 class FromRTEMSToFreeBSDHeaderConverter(Converter):
-    def convert(self, src):
-        data = super(FromRTEMSToFreeBSDHeaderConverter, self).convert(src)
-        data = revertFixLocalIncludes(data)
-        data = revertFixIncludes(data)
+    def convert(self, src, data = None):
+        data = super(FromRTEMSToFreeBSDHeaderConverter, self).convert(src, data)
+        data = _revertFixAllIncludes.rewrite(data)
         return data
 
 class FromRTEMSToFreeBSDSourceConverter(Converter):
-    def convert(self, src):
-        data = super(FromRTEMSToFreeBSDSourceConverter, self).convert(src)
-        data = re.sub('#include <machine/rtems-bsd-kernel-space.h>\n\n', '', data)
-        data = re.sub('#include <machine/rtems-bsd-user-space.h>\n\n', '', data)
-        data = revertFixLocalIncludes(data)
-        data = revertFixIncludes(data)
+    def convert(self, src, data = None):
+        data = super(FromRTEMSToFreeBSDSourceConverter, self).convert(src, data)
+        data = _revertFixSourceIncludes.rewrite(data)
         return data
 
 class PathComposer(object):
@@ -312,6 +1609,38 @@ class BuildSystemFragmentComposer(object):
     def compose(self, path):
         return ''
 
+#
+# Fragment Composer - a build system independent fragment of a file. It
+# records the kind of fragment and its arguments so every build system
+# generator can create its own composer from the one module graph.
+#
+class FragmentComposer(BuildSystemFragmentComposer):
+    def __init__(self, kind, *args, **kwargs):
+        self.kind = kind
+        self.args = args
+        self.kwargs = kwargs
+        self.composers = {}
+
+    def getComposer(self, generator):
+        if generator.name not in self.composers:
+            composer = generator.composers[self.kind](*self.args, **self.kwargs)
+            self.composers[generator.name] = composer
+        return self.composers[generator.name]
+
+    def compose(self, path):
+        raise error('%s fragment needs a build system generator' % (self.kind))
+
+class TestFragmentComposer(FragmentComposer):
+    def __init__(self, testName, fileFragments, runTest = True, netTest = False):
+        super(TestFragmentComposer, self).__init__('test', testName, fileFragments,
+                                                   runTest = runTest, netTest = netTest)
+        self.testName = testName
+
+def fragmentComposer(kind):
+    def _create(*args, **kwargs):
+        return FragmentComposer(kind, *args, **kwargs)
+    return _create
+
 class File(object):
     def __init__(self, path, pathComposer,
                  fromFreeBSDToRTEMSConverter, fromRTEMSToFreeBSDConverter, buildSystemComposer):
@@ -319,40 +1648,41 @@ class File(object):
         self.pathComposer = pathComposer
         self.fromFreeBSDToRTEMSConverter = fromFreeBSDToRTEMSConverter
         self.fromRTEMSToFreeBSDConverter = fromRTEMSToFreeBSDConverter
+        fromFreeBSDToRTEMSConverter.counterpart = fromRTEMSToFreeBSDConverter
+        fromRTEMSToFreeBSDConverter.counterpart = fromFreeBSDToRTEMSConverter
         self.buildSystemComposer = buildSystemComposer
+        self.module = None
 
     def copy(self, dst, src, converter = None):
-        import tempfile
-        if converter is not None and converter.isConvertible():
-            try:
-                if isDryRun == False:
-                    os.makedirs(os.path.dirname(dst))
-            except OSError:
-                pass
-            data = converter.convert(src)
-            try:
-                out = tempfile.NamedTemporaryFile(delete = False)
-                out.write(data)
-                out.close()
-                processIfDifferent(out.name, dst, src)
-            finally:
-                try:
-                    os.remove(out.name)
-                except:
-                    pass
+        copyToAll(src, [dst], converter)
 
-    def copyFromFreeBSDToRTEMS(self):
+    def getFromFreeBSDToRTEMS(self):
         src = self.pathComposer.composeFreeBSDPath(self.path)
         dst = self.pathComposer.composeRTEMSPath(self.path, RTEMS_DIR + '/')
-        self.copy(dst, src, self.fromFreeBSDToRTEMSConverter)
+        return src, dst, self.fromFreeBSDToRTEMSConverter
 
-    def copyFromRTEMSToFreeBSD(self):
+    def getFromRTEMSToFreeBSD(self):
         src = self.pathComposer.composeRTEMSPath(self.path, RTEMS_DIR + '/')
         dst = self.pathComposer.composeFreeBSDPath(self.path)
-        self.copy(dst, src, self.fromRTEMSToFreeBSDConverter)
+        return src, dst, self.fromRTEMSToFreeBSDConverter
+
+    def copyFromFreeBSDToRTEMS(self):
+        src, dst, converter = self.getFromFreeBSDToRTEMS()
+        self.copy(dst, src, converter)
+
+    def copyFromRTEMSToFreeBSD(self):
+        src, dst, converter = self.getFromRTEMSToFreeBSD()
+        self.copy(dst, src, converter)
+
+    def getComposer(self, generator = None):
+        composer = self.buildSystemComposer
+        if generator is not None and isinstance(composer, FragmentComposer):
+            composer = composer.getComposer(generator)
+        return composer
 
-    def getFragment(self):
-        return self.buildSystemComposer.compose(self.pathComposer.composeRTEMSPath(self.path, ''))
+    def getFragment(self, generator = None):
+        composer = self.getComposer(generator)
+        return composer.compose(self.pathComposer.composeRTEMSPath(self.path, ''))
 
 # Module - logical group of related files we can perform actions on
 class Module:
@@ -367,19 +1697,17 @@ class Module:
         if cpu not in self.cpuDependentSourceFiles:
             self.cpuDependentSourceFiles[cpu] = []
 
+    def getFiles(self):
+        files = list(self.files)
+        for cpu, cpuFiles in sorted(self.cpuDependentSourceFiles.items()):
+            files += cpuFiles
+        return files
+
     def copyFromFreeBSDToRTEMS(self):
-        for f in self.files:
-            f.copyFromFreeBSDToRTEMS()
-        for cpu, files in self.cpuDependentSourceFiles.items():
-            for f in files:
-                f.copyFromFreeBSDToRTEMS()
+        copyFiles(self.getFiles(), 'getFromFreeBSDToRTEMS')
 
     def copyFromRTEMSToFreeBSD(self):
-        for f in self.files:
-            f.copyFromRTEMSToFreeBSD()
-        for cpu, files in self.cpuDependentSourceFiles.items():
-            for f in files:
-                f.copyFromRTEMSToFreeBSD()
+        copyFiles(self.getFiles(), 'getFromRTEMSToFreeBSD')
 
     def addFiles(self, newFiles, buildSystemComposer = BuildSystemFragmentComposer()):
         files = []
@@ -480,6 +1808,7 @@ class ModuleManager:
     def __init__(self):
         self.modules = {}
         self.generator = {}
+        self.index = None
         self.setGenerators()
 
     def __getitem__(self, key):
@@ -487,16 +1816,211 @@ class ModuleManager:
             raise KeyError('module %s not found' % (key))
         return self.modules[key]
 
+    def setGenerators(self):
+        self.generator['convert'] = Converter
+        self.generator['no-convert'] = NoConverter
+
+        self.generator['file'] = File
+
+        self.generator['path'] = PathComposer
+        self.generator['freebsd-path'] = FreeBSDPathComposer
+        self.generator['rtems-path'] = RTEMSPathComposer
+        self.generator['cpu-path'] = CPUDependentPathComposer
+        self.generator['target-src-cpu--path'] = TargetSourceCPUDependentPathComposer
+
+        self.generator['source'] = fragmentComposer('source')
+        self.generator['test'] = TestFragmentComposer
+        self.generator['kvm-symbols'] = fragmentComposer('kvm-symbols')
+        self.generator['rpc-gen'] = fragmentComposer('rpc-gen')
+        self.generator['route-keywords'] = fragmentComposer('route-keywords')
+        self.generator['lex'] = fragmentComposer('lex')
+        self.generator['yacc'] = fragmentComposer('yacc')
+
     def getModules(self):
         return sorted(self.modules.keys())
 
     def addModule(self, module):
         self.modules[module.name] = module
-
-    def copyFromFreeBSDToRTEMS(self):
+        for f in module.getFiles():
+            f.module = module.name
+        self.index = None
+
+    # map the FreeBSD and the RTEMS path of every file to the module, file
+    # and CPU owning it, the CPU is None for files not dependent on a CPU
+    def buildIndex(self):
+        self.index = {}
+        for entry in self.getOwners():
+            m, f, cpu = entry
+            paths = [f.pathComposer.composeFreeBSDPath(f.path),
+                     f.pathComposer.composeRTEMSPath(f.path, '')]
+            for path in set([os.path.normpath(p) for p in paths]):
+                self.index.setdefault(path, []).append(entry)
+
+    # the (module, file, cpu) entries of all files
+    def getOwners(self):
+        owners = []
+        for mn in self.getModules():
+            m = self.modules[mn]
+            owners += [(m, f, None) for f in m.files]
+            for cpu, files in sorted(m.cpuDependentSourceFiles.items()):
+                owners += [(m, f, cpu) for f in files]
+        return owners
+
+    # the paths relative to the FreeBSD directory of the files taken from
+    # FreeBSD
+    def getFreeBSDPaths(self):
+        prefix = os.path.normpath(FreeBSD_DIR) + os.sep
+        paths = set()
+        for m, f, cpu in self.getOwners():
+            path = os.path.normpath(f.pathComposer.composeFreeBSDPath(f.path))
+            if path.startswith(prefix):
+                paths.add(path[len(prefix):])
+        return sorted(paths)
+
+    # check that every RTEMS file is listed once, the warnings are returned
+    #  + a file listed twice in a module or claimed by two modules with the
+    #    same source and converters is a warning
+    #  + the CPUs of a module may share a file
+    #  + an RTEMS file with different sources or converters is an error
+    def validate(self):
+        if self.index is None:
+            self.buildIndex()
+        warnings = []
+        errors = []
+        for path in sorted(self.index):
+            entries = self.index[path]
+            if len(entries) == 1:
+                continue
+            # The index has the FreeBSD paths as well
+            entries = [(m, f, cpu) for m, f, cpu in entries
+                       if os.path.normpath(f.pathComposer.composeRTEMSPath(f.path, '')) == path]
+            if len(entries) < 2:
+                continue
+            sources = set()
+            for m, f, cpu in entries:
+                sources.add((os.path.normpath(f.pathComposer.composeFreeBSDPath(f.path)),
+                             f.fromFreeBSDToRTEMSConverter.__class__,
+                             f.fromRTEMSToFreeBSDConverter.__class__))
+            modules = sorted(set([m.name for m, f, cpu in entries]))
+            owners = set([(m.name, cpu) for m, f, cpu in entries])
+            if len(sources) > 1:
+                errors += ['%s: different sources or converters in module(s) %s' % \
+                           (path, ', '.join(modules))]
+            elif len(modules) > 1:
+                warnings += ['%s: claimed by modules %s' % (path, ', '.join(modules))]
+            elif len(owners) < len(entries):
+                warnings += ['%s: listed %d times in module %s' % \
+                             (path, len(entries), modules[0])]
+        if len(errors) > 0:
+            raise error('invalid modules:\n  ' + '\n  '.join(errors))
+        return warnings
+
+    # the (module, file, cpu) entries owning a path, the path is a FreeBSD
+    # path including the FreeBSD directory or a path in the RTEMS directory
+    def lookup(self, path):
+        if self.index is None:
+            self.buildIndex()
+        path = os.path.normpath(path)
+        entries = self.index.get(path, [])
+        rtemsDir = os.path.normpath(RTEMS_DIR)
+        if len(entries) == 0 and path.startswith(rtemsDir + os.sep):
+            entries = self.index.get(path[len(rtemsDir) + 1:], [])
+        return entries
+
+    def getFiles(self):
+        files = []
         for m in sorted(self.modules):
-            self.modules[m].copyFromFreeBSDToRTEMS()
+            files += self.modules[m].getFiles()
+        return files
 
-    def copyFromRTEMSToFreeBSD(self):
-        for m in sorted(self.modules):
-            self.modules[m].copyFromRTEMSToFreeBSD()
+    # the named modules and the modules they depend on in topological order,
+    # a module follows the modules it depends on
+    def getModuleClosure(self, names):
+        order = []
+        def _visit(name, path):
+            if name not in self.modules:
+                raise error('module %s not found' % (name))
+            if name in path:
+                raise error('module dependency cycle: ' + ' -> '.join(path + [name]))
+            if name in order:
+                return
+            for dep in self.modules[name].dependencies:
+                _visit(dep.name, path + [name])
+            order.append(name)
+        for name in names:
+            _visit(name, [])
+        return order
+
+    # the names of all modules, a module precedes the modules it declares a
+    # dependency on
+    def getLinkOrder(self):
+        order = self.getModuleClosure(self.getModules())
+        order.reverse()
+        return order
+
+    # the files of the named modules and the modules they depend on
+    def getFilesByModule(self, names):
+        files = []
+        for m in self.getModuleClosure(names):
+            files += self.modules[m].getFiles()
+        return files
+
+    # the files of all modules with one of the paths, the paths are relative
+    # to the FreeBSD directory
+    def getFilesByFreeBSDPath(self, paths):
+        files = []
+        seen = set()
+        for path in paths:
+            freebsdPath = os.path.normpath(os.path.join(FreeBSD_DIR, path))
+            for m, f, cpu in self.lookup(freebsdPath):
+                if f not in seen and \
+                   os.path.normpath(f.pathComposer.composeFreeBSDPath(f.path)) == freebsdPath:
+                    seen.add(f)
+                    files += [f]
+        return files
+
+    def copyFromFreeBSDToRTEMS(self, files = None):
+        if files is None:
+            files = self.getFiles()
+        copyFiles(files, 'getFromFreeBSDToRTEMS')
+
+    def copyFromRTEMSToFreeBSD(self, files = None):
+        if files is None:
+            files = self.getFiles()
+        copyFiles(files, 'getFromRTEMSToFreeBSD')
+
+#
+# Build System Generator - generates the files of a build system from the
+# modules of a module manager. Each build system provides the composers for
+# the kinds of fragments.
+#
+class BuildSystemGenerator(object):
+    name = None
+
+    def __init__(self, mm):
+        self.mm = mm
+        self.composers = {}
+        self.setComposers()
+
+    def setComposers(self):
+        pass
+
+    def getModules(self):
+        return self.mm.getModules()
+
+    def __getitem__(self, key):
+        return self.mm[key]
+
+    def run(self):
+        global currentModule
+        currentModule = self.name
+        if profiler is not None:
+            profiler.module = None
+        profileStart('generate:' + self.name)
+        try:
+            self.generate()
+        finally:
+            profileStop()
+
+    def generate(self):
+        pass
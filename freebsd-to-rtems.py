@@ -42,40 +42,103 @@ import getopt
 import builder
 import makefile
 import waf_generator
+import ninja_generator
 import libbsd
 
 isForward = True
 isEarlyExit = False
 isOnlyMakefile = False
+isSyncCache = True
+isResume = False
+changedFrom = None
+changedFiles = None
+whichPath = None
+profileReport = None
+diffOutput = None
+isDiffLimit = False
+modules = []
+freebsdRev = None
+sparseCheckout = None
+conversionCache = None
+conversionCacheSize = 256
 
 def usage():
     print "freebsd-to-rtems.py [args]"
     print "  -?|-h|--help     print this and exit"
     print "  -d|--dry-run     run program but no modifications"
     print "  -D|--diff        provide diff of files between trees"
+    print "  --diff-output FILE"
+    print "                   write the diff as one patch to FILE, needs -D"
+    print "  --diff-limit N   do not diff files larger than N bytes, 0 for no limit,"
+    print "                   needs -D (default: 1048576)"
     print "  -e|--early-exit  evaluate arguments, print results, and exit"
-    print "  -m|--makefile    just generate Makefile"
+    print "  -m|--makefile    just generate Makefile, waf script and Ninja file"
     print "  -R|--reverse     default FreeBSD -> RTEMS, reverse that"
     print "  -r|--rtems       RTEMS Libbsd directory (default: '.')"
     print "  -f|--freebsd     FreeBSD SVN directory (default: 'freebsd-org')"
+    print "  --freebsd-rev REV"
+    print "                   read the FreeBSD files of revision REV from the git"
+    print "                   repository in the FreeBSD directory, no checkout needed"
+    print "  -j|--jobs N      process files with N parallel jobs (default: 1)"
+    print "  --io-threads N   overlap reading, converting and writing the files with"
+    print "                   N reader and N writer threads, ignored with -j"
+    print "                   (default: 0)"
+    print "  -C|--no-cache    do not use the sync cache to skip unchanged files"
+    print "  --conversion-cache DIR"
+    print "                   keep the converted files in the cache directory DIR"
+    print "  --conversion-cache-size MB"
+    print "                   limit the conversion cache to MB megabytes"
+    print "                   (default: 256)"
+    print "  --resume         continue an interrupted sync from its journal"
+    print "  --changed-from REV"
+    print "                   only process files changed in the FreeBSD git"
+    print "                   directory since revision REV"
+    print "  --changed-files LIST"
+    print "                   only process the FreeBSD files listed in the file LIST"
+    print "  --module LIST    only process the files of the comma separated modules"
+    print "                   and the modules they depend on"
+    print "  --which PATH     print the module and file owning the FreeBSD or RTEMS"
+    print "                   path and exit"
+    print "  --sparse-checkout FILE"
+    print "                   write the git sparse-checkout patterns of the FreeBSD"
+    print "                   files used to FILE and exit"
+    print "  --profile FILE   print the time spent per stage and module and write it"
+    print "                   as JSON to FILE"
     print "  -v|--verbose     enable verbose output mode"
 
 # Parse the arguments
 def parseArguments():
     global isForward, isEarlyExit
-    global isOnlyMakefile
+    global isOnlyMakefile, isSyncCache, isResume
+    global changedFrom, changedFiles, whichPath, profileReport
+    global diffOutput, isDiffLimit, modules, freebsdRev, sparseCheckout
+    global conversionCache, conversionCacheSize
     try:
         opts, args = getopt.getopt(sys.argv[1:],
-                                   "?hdDemRr:f:v",
+                                   "?hdDemRr:f:j:Cv",
                                    [ "help",
-                                     "help",
-                                     "dry-run"
-                                     "diff"
-                                     "early-exit"
-                                     "makefile"
-                                     "reverse"
-                                     "rtems="
-                                     "freebsd="
+                                     "dry-run",
+                                     "diff",
+                                     "early-exit",
+                                     "makefile",
+                                     "reverse",
+                                     "rtems=",
+                                     "freebsd=",
+                                     "freebsd-rev=",
+                                     "jobs=",
+                                     "io-threads=",
+                                     "no-cache",
+                                     "resume",
+                                     "conversion-cache=",
+                                     "conversion-cache-size=",
+                                     "changed-from=",
+                                     "changed-files=",
+                                     "module=",
+                                     "which=",
+                                     "sparse-checkout=",
+                                     "profile=",
+                                     "diff-output=",
+                                     "diff-limit=",
                                      "verbose" ])
     except getopt.GetoptError, err:
         # print help information and exit:
@@ -102,6 +165,59 @@ def parseArguments():
             builder.RTEMS_DIR = a
         elif o in ("-f", "--freebsd"):
             builder.FreeBSD_DIR = a
+        elif o == "--freebsd-rev":
+            freebsdRev = a
+        elif o in ("-j", "--jobs"):
+            try:
+                builder.jobs = int(a)
+            except ValueError:
+                builder.jobs = 0
+            if builder.jobs < 1:
+                print "error: invalid number of jobs: " + a
+                sys.exit(2)
+        elif o == "--io-threads":
+            try:
+                builder.ioThreads = int(a)
+            except ValueError:
+                builder.ioThreads = -1
+            if builder.ioThreads < 0:
+                print "error: invalid number of I/O threads: " + a
+                sys.exit(2)
+        elif o in ("-C", "--no-cache"):
+            isSyncCache = False
+        elif o == "--conversion-cache":
+            conversionCache = a
+        elif o == "--conversion-cache-size":
+            try:
+                conversionCacheSize = int(a)
+            except ValueError:
+                conversionCacheSize = -1
+            if conversionCacheSize < 0:
+                print "error: invalid conversion cache size: " + a
+                sys.exit(2)
+        elif o == "--resume":
+            isResume = True
+        elif o == "--changed-from":
+            changedFrom = a
+        elif o == "--changed-files":
+            changedFiles = a
+        elif o == "--module":
+            modules += [m for m in a.split(',') if m != '']
+        elif o == "--which":
+            whichPath = a
+        elif o == "--sparse-checkout":
+            sparseCheckout = a
+        elif o == "--profile":
+            profileReport = a
+        elif o == "--diff-output":
+            diffOutput = a
+        elif o == "--diff-limit":
+            isDiffLimit = True
+            try:
+                builder.diffLimit = int(a)
+            except ValueError:
+                print "error: invalid diff limit: " + a
+                sys.exit(2)
         else:
             assert False, "unhandled option"
 
@@ -113,7 +229,59 @@ print "Diff Mode Enabled:      " + ("no", "yes")[builder.isDiffMode]
 print "Only Generate Makefile: " + ("no", "yes")[isOnlyMakefile]
 print "RTEMS Libbsd Directory: " + builder.RTEMS_DIR
 print "FreeBSD SVN Directory:  " + builder.FreeBSD_DIR
+if freebsdRev is not None:
+    print "FreeBSD Revision:       " + freebsdRev
 print "Direction:              " + ("reverse", "forward")[isForward]
+print "Jobs:                   %d" % (builder.jobs)
+if builder.ioThreads > 0:
+    print "I/O Threads:            %d" % (builder.ioThreads)
+print "Sync Cache:             " + ("no", "yes")[isSyncCache]
+if isResume:
+    print "Resume:                 yes"
+if conversionCache is not None:
+    print "Conversion Cache:       %s (%d MB)" % (conversionCache, conversionCacheSize)
+if changedFrom is not None:
+    print "Changed From:           " + changedFrom
+if changedFiles is not None:
+    print "Changed Files:          " + changedFiles
+if len(modules) > 0:
+    print "Modules:                " + ', '.join(modules)
+
+# Print the owners of a path and exit
+if whichPath is not None:
+    mm = builder.ModuleManager()
+    libbsd.sources(mm)
+    entries = mm.lookup(whichPath)
+    if len(entries) == 0:
+        print "%s: not in a module" % (whichPath)
+        sys.exit(1)
+    for m, f, cpu in entries:
+        if cpu is None:
+            cpu = "all"
+        print "%s: module %s, CPU %s" % (whichPath, m.name, cpu)
+        print "  FreeBSD: " + f.pathComposer.composeFreeBSDPath(f.path)
+        print "  RTEMS:   " + f.pathComposer.composeRTEMSPath(f.path, "")
+    sys.exit(0)
+
+# Write the sparse checkout patterns of the FreeBSD files and exit
+if sparseCheckout is not None:
+    mm = builder.ModuleManager()
+    libbsd.sources(mm)
+    files = mm.getFreeBSDPaths()
+    dirs = []
+    todo = os.path.join(builder.RTEMS_DIR, 'Makefile.todo')
+    if os.path.exists(todo):
+        todoFiles, dirs = builder.makefileFreeBSDPaths(todo)
+        files += todoFiles
+    patterns = builder.sparseCheckoutPatterns(files, dirs)
+    out = open(sparseCheckout, 'w')
+    try:
+        out.write('# FreeBSD files used by rtems-libbsd, generated by freebsd-to-rtems.py\n')
+        out.write(''.join([pattern + '\n' for pattern in patterns]))
+    finally:
+        out.close()
+    print '%d pattern(s) written to %s' % (len(patterns), sparseCheckout)
+    sys.exit(0)
 
 # Check directory argument was set and exist
 def wasDirectorySet(desc, path):
@@ -137,28 +305,123 @@ else:
     if isOnlyMakefile == True:
         print "error: Makefile Mode and Reverse are contradictory"
         sys.exit(2)
+    if freebsdRev is not None:
+        print "error: --freebsd-rev and Reverse are contradictory"
+        sys.exit(2)
+
+if changedFrom is not None and changedFiles is not None:
+    print "error: --changed-from and --changed-files are contradictory"
+    sys.exit(2)
+
+if not builder.isDiffMode and (diffOutput is not None or isDiffLimit):
+    print "error: --diff-output and --diff-limit need Diff Mode (-D)"
+    sys.exit(2)
+
+if isResume and (builder.isDryRun or builder.isDiffMode or not isForward):
+    print "error: --resume and Dry Run, Diff Mode or Reverse are contradictory"
+    sys.exit(2)
 
 if isEarlyExit == True:
     print "Early exit at user request"
     sys.exit(0)
 
+if profileReport is not None:
+    builder.profiler = builder.Profiler()
+
+if builder.isDiffMode:
+    builder.diffStat = builder.DiffStat()
+    if diffOutput is not None:
+        builder.diffOutput = open(diffOutput, 'w')
+
 try:
-    makefile_gen = makefile.ModuleManager()
-    waf_gen = waf_generator.ModuleManager()
+    mm = builder.ModuleManager()
+    libbsd.sources(mm)
+
+    # Check the modules before touching any file
+    warnings = mm.validate()
+    if builder.isVerbose == True:
+        for warning in warnings:
+            print 'warning: ' + warning
+    elif len(warnings) > 0:
+        print '%d file(s) listed more than once in the modules, use -v to list them.' % \
+            (len(warnings))
+
+    generators = [makefile.Generator(mm),
+                  waf_generator.Generator(mm),
+                  ninja_generator.Generator(mm)]
+
+    if isSyncCache and not isOnlyMakefile:
+        builder.loadSyncCache()
+
+    if freebsdRev is not None and not isOnlyMakefile:
+        builder.openSourceStore(freebsdRev)
 
-    libbsd.sources(makefile_gen)
-    libbsd.sources(waf_gen)
+    if conversionCache is not None and not isOnlyMakefile:
+        builder.openConversionCache(conversionCache, conversionCacheSize * 1024 * 1024)
+
+    # Restrict the files to the changed upstream files
+    files = None
+    if changedFrom is not None:
+        changed = builder.changedFromGit(changedFrom)
+    elif changedFiles is not None:
+        changed = builder.changedFromList(changedFiles)
+    if changedFrom is not None or changedFiles is not None:
+        files = mm.getFilesByFreeBSDPath(changed)
+        print '%d changed upstream file(s), %d in the modules.' % (len(changed), len(files))
+
+    # Restrict the files to the modules and their dependencies
+    if len(modules) > 0:
+        closure = mm.getModuleClosure(modules)
+        if files is None:
+            files = mm.getFilesByModule(closure)
+        else:
+            files = [f for f in files if f.module in closure]
+        print 'Modules with dependencies: ' + ', '.join(closure)
 
     # Perform the actual file manipulation
     if isForward:
         if not isOnlyMakefile:
-            makefile_gen.copyFromFreeBSDToRTEMS()
-        makefile_gen.generate()
-        waf_gen.generate()
+            # Stage the changed files and move them into place at the end
+            if not builder.isDiffMode and not builder.isDryRun:
+                builder.beginStaging(isResume)
+                if builder.staging.getResumed() > 0:
+                    print '%d file(s) resumed from the journal.' % \
+                        (builder.staging.getResumed())
+            mm.copyFromFreeBSDToRTEMS(files)
+            if builder.staging is not None:
+                builder.filesProcessed += builder.commitStaging()
+        for generator in generators:
+            generator.run()
     else:
-        makefile_gen.copyFromRTEMSToFreeBSD()
+        if not builder.isDiffMode:
+            if files is None:
+                files = mm.getFiles()
+            planned = builder.plannedCopies(files, 'getFromRTEMSToFreeBSD')
+            changed = [copy[1] for copy in planned if copy[5]]
+            print '%d upstream file(s) to be changed:' % (len(changed))
+            for dst in changed:
+                print '  ' + dst
+            builder.copyPlanned(planned)
+        else:
+            mm.copyFromRTEMSToFreeBSD(files)
+    builder.closeSourceStore()
+    if builder.conversionCache is not None:
+        builder.conversionCache.report()
+        builder.closeConversionCache()
+    builder.saveSyncCache()
     # Print a summary if changing files
     if builder.isDiffMode == False:
         print '%d file(s) were changed.' % (builder.filesProcessed)
+    else:
+        if builder.diffOutput is not None:
+            builder.diffOutput.close()
+        builder.diffStat.report()
+    if builder.profiler is not None:
+        builder.profiler.report()
+        builder.profiler.save(profileReport)
 except IOError, ioe:
     print 'error: %s' % (ioe)
+    sys.exit(1)
+except builder.error, e:
+    print e
+    sys.exit(1)
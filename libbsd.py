@@ -2621,6 +2621,3 @@ def sources(mm):
     mm.addModule(dhcpcd(mm))
     mm.addModule(mghttpd(mm))
     mm.addModule(mdnsresponder(mm))
-
-    # XXX TODO Check that no file is also listed in empty
-    # XXX TODO Check that no file in in two modules
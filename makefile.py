@@ -32,7 +32,7 @@
 #  (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 #  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-import tempfile
+import os
 
 import builder
 
@@ -43,7 +43,7 @@ class SourceFileFragmentComposer(builder.BuildSystemFragmentComposer):
         self.includes = includes
 
     def compose(self, path):
-        fragment = 'LIB_C_FILES += ' + path + '\n'
+        fragment = 'MODULE_C_FILES += ' + path + '\n'
         cflags = ''
         if self.includes != None:
             if type(self.includes) is list:
@@ -98,7 +98,7 @@ class KVMSymbolsFragmentComposer(builder.BuildSystemFragmentComposer):
 
     def compose(self, path):
         return 'LIB_GEN_FILES += ' + path + '\n' \
-            'LIB_C_FILES += ' + path + '\n' \
+            'MODULE_C_FILES += ' + path + '\n' \
             + path + ': rtemsbsd/rtems/generate_kvm_symbols\n' \
             '\t./$< > $@\n'
 
@@ -106,7 +106,8 @@ class RPCGENFragmentComposer(builder.BuildSystemFragmentComposer):
 
     def compose(self, path):
         headerPath = path[:-2] + '.h'
-        return headerPath + ': ' + path + '\n' \
+        return 'LIB_GEN_HEADERS += ' + headerPath + '\n' \
+            + headerPath + ': ' + path + '\n' \
             '\t	rm -f $@\n' \
             '\t	rpcgen -h -o $@ $<\n'
 
@@ -114,12 +115,12 @@ class RouteKeywordsFragmentComposer(builder.BuildSystemFragmentComposer):
 
     def compose(self, path):
         headerPath = path + '.h'
-        tmpPath = path + '.tmp'
-        return headerPath + ': ' + path + '\n' \
-            '\tsed -e \'/^#/d\' -e \'/^$$/d\' $< > ' + tmpPath + '\n' \
-            '\tLC_ALL=C tr \'a-z\' \'A-Z\' < ' + tmpPath + ' | paste ' + tmpPath + ' - | \\\n' \
+        return 'LIB_GEN_HEADERS += ' + headerPath + '\n' \
+            + headerPath + ': ' + path + '\n' \
+            '\tsed -e \'/^#/d\' -e \'/^$$/d\' $< > $@.tmp\n' \
+            '\tLC_ALL=C tr \'a-z\' \'A-Z\' < $@.tmp | paste $@.tmp - | \\\n' \
             '\tawk \'{ if (NF > 1) printf "#define\\tK_%s\\t%d\\n\\t{\\"%s\\", K_%s},\\n", $$2, NR, $$1, $$2 }\' > $@\n' \
-            '\trm -f ' + tmpPath + '\n'
+            '\trm -f $@.tmp\n'
 
 class LexFragmentComposer(builder.BuildSystemFragmentComposer):
 
@@ -135,7 +136,7 @@ class LexFragmentComposer(builder.BuildSystemFragmentComposer):
     def compose(self, path):
         src = path[:-2] + '.c'
         dep = path[:path.rfind('/')] + '/' + self.dep
-        fragment = 'LIB_C_FILES += ' + src + '\n' \
+        fragment = 'MODULE_C_FILES += ' + src + '\n' \
             + src + ': ' + path + ' ' + dep + '\n' \
             '\t${LEX} -P ' + self.sym + ' -t $< | sed -e \'/YY_BUF_SIZE/s/16384/1024/\' > $@\n'
         if len(self.cflags) > 0:
@@ -158,42 +159,45 @@ class YaccFragmentComposer(builder.BuildSystemFragmentComposer):
         src = path[:-2] + '.c'
         hdr = path[:path.rfind('/')] + '/' + self.header
         if self.sym is not None:
-            sym = '-b %s' % (self.sym)
+            sym = self.sym
         else:
             sym = os.path.basename(src)[:-2]
-        fragment = 'LIB_C_FILES += ' + src + '\n' \
+        #
+        # The yacc outputs get names of their own next to the grammar so
+        # parallel builds do not share them. The header is a target of its
+        # own which recovers from its removal, see 'Multiple Outputs' in the
+        # Automake manual. The header is touched after the move to be newer
+        # than the C file.
+        #
+        tmp = path[:-2] + '.yacc'
+        fragment = 'MODULE_C_FILES += ' + src + '\n' \
+            'LIB_GEN_HEADERS += ' + hdr + '\n' \
             + src + ': ' + path + '\n' \
-            '\tyacc -b ' + sym + ' -d -p ' + sym + ' $<\n' \
-            '\tsed -e ''/YY_BUF_SIZE/s/16384/1024/'' < ' + sym + '.tab.c > $@\n' \
-            '\trm -f ' + sym + '.tab.c\n' \
-            '\tmv ' + sym + '.tab.h ' + hdr + '\n'
+            '\tyacc -b ' + tmp + ' -d -p ' + sym + ' $<\n' \
+            '\tsed -e \'/YY_BUF_SIZE/s/16384/1024/\' < ' + tmp + '.tab.c > $@\n' \
+            '\trm -f ' + tmp + '.tab.c\n' \
+            '\tmv ' + tmp + '.tab.h ' + hdr + '\n' \
+            '\ttouch ' + hdr + '\n' \
+            + hdr + ': ' + src + '\n' \
+            '\t@test -f $@ || rm -f ' + src + '\n' \
+            '\t@test -f $@ || $(MAKE) ' + src + '\n'
         if len(self.cflags) > 0:
             fragment = fragment + src[:-1] + 'o: ' + src + '\n' \
                        + '\t$(CC) $(CPPFLAGS) $(CFLAGS) ' + self.cflags + ' -c $< -o $@\n'
         return fragment
 
-# Module Manager - Collection of Modules
-class ModuleManager(builder.ModuleManager):
+# Makefile Generator
+class Generator(builder.BuildSystemGenerator):
+    name = 'makefile'
 
-    def setGenerators(self):
-        self.generator['convert'] = builder.Converter
-        self.generator['no-convert'] = builder.NoConverter
-
-        self.generator['file'] = builder.File
-
-        self.generator['path'] = builder.PathComposer
-        self.generator['freebsd-path'] = builder.FreeBSDPathComposer
-        self.generator['rtems-path'] = builder.RTEMSPathComposer
-        self.generator['cpu-path'] = builder.CPUDependentPathComposer
-        self.generator['target-src-cpu--path'] = builder.TargetSourceCPUDependentPathComposer
-
-        self.generator['source'] = SourceFileFragmentComposer
-        self.generator['test'] = TestFragementComposer
-        self.generator['kvm-symbols'] = KVMSymbolsFragmentComposer
-        self.generator['rpc-gen'] = RPCGENFragmentComposer
-        self.generator['route-keywords'] = RouteKeywordsFragmentComposer
-        self.generator['lex'] = LexFragmentComposer
-        self.generator['yacc'] = YaccFragmentComposer
+    def setComposers(self):
+        self.composers['source'] = SourceFileFragmentComposer
+        self.composers['test'] = TestFragementComposer
+        self.composers['kvm-symbols'] = KVMSymbolsFragmentComposer
+        self.composers['rpc-gen'] = RPCGENFragmentComposer
+        self.composers['route-keywords'] = RouteKeywordsFragmentComposer
+        self.composers['lex'] = LexFragmentComposer
+        self.composers['yacc'] = YaccFragmentComposer
 
     def generate(self):
         data = 'include config.inc\n' \
@@ -248,24 +252,57 @@ class ModuleManager(builder.ModuleManager):
                '\n' \
                'LIB = libbsd.a\n' \
                'LIB_GEN_FILES =\n' \
+               'LIB_GEN_HEADERS =\n' \
                'LIB_C_FILES =\n' \
                'LIB_CXX_FILES =\n' \
                'LIB_CXX_FILES += rtemsbsd/rtems/rtems-bsd-cxx.cc\n'
+        #
+        # The C files of each module are collected in MODULE_C_FILES first to
+        # build the library of the module from them.
+        #
+        libs = []
         for mn in self.getModules():
             m = self[mn]
-            if m.conditionalOn != "none":
-                data += 'ifneq ($(' + m.conditionalOn + '),yes)\n'
+            lib = 'LIB_' + mn.upper()
+            moduleData = ''
             for f in m.files:
-                data += f.getFragment()
+                moduleData += f.getFragment(self)
             for cpu, files in sorted(m.cpuDependentSourceFiles.items()):
-                data += 'ifeq ($(RTEMS_CPU), ' + cpu + ')\n'
+                moduleData += 'ifeq ($(RTEMS_CPU), ' + cpu + ')\n'
                 for f in files:
-                    data += f.getFragment()
+                    moduleData += f.getFragment(self)
                 if cpu in ("arm", "i386", "lm32", "mips", "powerpc", "sparc", "m68k"):
-                    data += 'NEED_DUMMY_PIC_IRQ=no\n'
-                data += 'endif\n'
-                if m.conditionalOn != "none":
-                    data += 'endif # ' + m.conditionalOn +'\n'
+                    moduleData += 'NEED_DUMMY_PIC_IRQ=no\n'
+                moduleData += 'endif\n'
+            if 'MODULE_C_FILES += ' in moduleData:
+                libs += [mn]
+                moduleData = 'MODULE_C_FILES :=\n' \
+                             + moduleData \
+                             + lib + '_C_FILES := $(MODULE_C_FILES)\n' \
+                             'LIB_C_FILES += $(' + lib + '_C_FILES)\n' \
+                             + lib + ' = libbsd-' + mn + '.a\n' \
+                             '$(' + lib + '): $(' + lib + '_C_FILES:%.c=%.o)\n' \
+                             '\trm -f $@\n' \
+                             '\t$(AR) rcu $@ $^\n'
+            if m.conditionalOn != "none":
+                moduleData = 'ifneq ($(' + m.conditionalOn + '),yes)\n' \
+                             + moduleData \
+                             + 'endif # ' + m.conditionalOn +'\n'
+            data += moduleData
+        #
+        # The module libraries, a library of a module not built is empty.  The
+        # modules depend on each other in cycles which are not declared, so
+        # programs link them through the thin libbsd.a.
+        #
+        data += 'LIB_CXX = libbsd-cxx.a\n' \
+                '$(LIB_CXX): $(LIB_CXX_FILES:%.cc=%.o)\n' \
+                '\trm -f $@\n' \
+                '\t$(AR) rcu $@ $^\n' \
+                'LIB_MODULES =\n'
+        for mn in self.mm.getLinkOrder():
+            if mn in libs:
+                data += 'LIB_MODULES += $(LIB_' + mn.upper() + ')\n'
+        data += 'LIB_MODULES += $(LIB_CXX)\n'
         data += '\n' \
                 'ifeq ($(NEED_DUMMY_PIC_IRQ),yes)\n' \
                 'CFLAGS += -I rtems-dummy-pic-irq/include\n' \
@@ -274,11 +311,23 @@ class ModuleManager(builder.ModuleManager):
                 'O_FILES += $(LIB_O_FILES)\n' \
                 'D_FILES += $(LIB_C_FILES:%.c=%.d) $(LIB_CXX_FILES:%.cc=%.d)\n' \
                 '\n' \
+                '# The generated headers are made before any object, the dependency\n' \
+                '# files of the objects tell which objects include them\n' \
+                '$(O_FILES): | $(LIB_GEN_HEADERS)\n' \
+                '\n' \
                 'all: $(LIB) $(TESTS) $(TEST_NETWORK_CONFIG) $(NET_TESTS)\n' \
                 '\n' \
+                'ifeq ($(MODULE_LIBS),yes)\n' \
+                'LIB_FILES = $(LIB) $(LIB_MODULES)\n' \
+                '$(LIB): $(LIB_GEN_FILES) $(LIB_MODULES)\n' \
+                '\trm -f $@\n' \
+                '\t$(AR) rcT $@ $(LIB_MODULES)\n' \
+                'else\n' \
+                'LIB_FILES = $(LIB)\n' \
                 '$(LIB): $(LIB_GEN_FILES) $(LIB_O_FILES)\n' \
                 '\trm -f $@\n' \
                 '\t$(AR) rcu $@ $^\n' \
+                'endif\n' \
                 '\n' \
                 'run_tests: $(RUN_TESTS)\n' \
                 '\t$(TEST_RUNNER) $^\n' \
@@ -307,7 +356,7 @@ class ModuleManager(builder.ModuleManager):
                 '\n' \
                 'install: $(LIB)\n' \
                 '\tinstall -d $(LIB_DIR)\n' \
-                '\tinstall -m 644 $(LIB) $(LIB_DIR)\n' \
+                '\tinstall -m 644 $(LIB_FILES) $(LIB_DIR)\n' \
                 '\tcd rtemsbsd/include ; for i in `find . -type d` ; do \\\n' \
                 '\t  install -d $(INCLUDE_DIR)/$$i ; \\\n' \
                 '\t  install -m 644 $$i/*.h $(INCLUDE_DIR)/$$i ; done\n' \
@@ -331,7 +380,7 @@ class ModuleManager(builder.ModuleManager):
                 '\tinstall -m 644 mDNSResponder/mDNSPosix/mDNSPosix.h $(INCLUDE_DIR)\n' \
                 '\n' \
                 'clean:\n' \
-                '\trm -f $(LIB_GEN_FILES) $(LIB) $(TESTS) $(O_FILES) $(D_FILES)\n' \
+                '\trm -f $(LIB_GEN_FILES) $(LIB) $(LIB_MODULES) $(TESTS) $(O_FILES) $(D_FILES)\n' \
                 '\trm -f libbsd.html\n' \
                 '\n' \
                 '-include $(D_FILES)\n' \
@@ -340,14 +389,5 @@ class ModuleManager(builder.ModuleManager):
                 '\n' \
                 'libbsd.html: libbsd.txt\n' \
                 '\tasciidoc -o libbsd.html libbsd.txt\n'
-        try:
-            out = tempfile.NamedTemporaryFile(delete = False)
-            out.write(data)
-            out.close()
-            makefile = builder.RTEMS_DIR + '/Makefile'
-            builder.processIfDifferent(out.name, makefile, "Makefile")
-        finally:
-            try:
-                os.remove(out.name)
-            except:
-                pass
+        makefile = builder.RTEMS_DIR + '/Makefile'
+        builder.processDataIfDifferent(data, makefile, "Makefile")
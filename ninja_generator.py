@@ -0,0 +1,388 @@
+#
+#  Copyright (c) 2015 Chris Johns <chrisj@rtems.org>. All rights reserved.
+#
+#  Copyright (c) 2009-2015 embedded brains GmbH.  All rights reserved.
+#
+#   embedded brains GmbH
+#   Dornierstr. 4
+#   82178 Puchheim
+#   Germany
+#   <info@embedded-brains.de>
+#
+#  Copyright (c) 2012 OAR Corporation. All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions
+#  are met:
+#  1. Redistributions of source code must retain the above copyright
+#     notice, this list of conditions and the following disclaimer.
+#  2. Redistributions in binary form must reproduce the above copyright
+#     notice, this list of conditions and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+#  "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+#  LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+#  A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+#  OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+#  SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+#  LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+#  DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+#  THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#  (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+#  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import pipes
+
+import builder
+
+#
+# The composers return the outputs of their fragment by the group the
+# generator collects them in and the Ninja build statements. Objects are
+# placed in $objdir which the generator sets for the common and for each
+# CPU specific part.
+#
+def _quote(flag):
+    return pipes.quote(flag).replace('$', '$$')
+
+def _flags(cflags, includes):
+    flags = []
+    if includes is not None:
+        if type(includes) is not list:
+            includes = [includes]
+        flags += ['-I' + i for i in includes if i is not None]
+    if cflags is not None:
+        if type(cflags) is list:
+            flags += cflags
+        else:
+            flags += cflags.split()
+    return ' '.join([_quote(f) for f in flags])
+
+def _compile(src, flags):
+    obj = '$objdir/' + os.path.splitext(src)[0] + '.o'
+    fragment = 'build ' + obj + ': cc ' + src + ' || headers\n'
+    if len(flags) > 0:
+        fragment += '  flags = ' + flags + '\n'
+    return obj, fragment
+
+class SourceFileFragmentComposer(builder.BuildSystemFragmentComposer):
+
+    def __init__(self, cflags = None, includes = None):
+        self.flags = _flags(cflags, includes)
+
+    def compose(self, path):
+        obj, fragment = _compile(path, self.flags)
+        return { 'objects': [obj] }, fragment
+
+class TestFragementComposer(builder.BuildSystemFragmentComposer):
+
+    def __init__(self, testName, fileFragments, runTest = True, netTest = False):
+        self.testName = testName
+        self.fileFragments = fileFragments
+        self.runTest = runTest
+        self.netTest = netTest
+
+    def compose(self, path):
+        testDir = 'testsuite/' + self.testName
+        testExe = '$builddir/' + testDir + '/' + self.testName + '.exe'
+        testMap = '$builddir/' + testDir + '/' + self.testName + '.map'
+        testCollection = 'tests'
+        if self.netTest:
+            testCollection = 'net-' + testCollection
+        fragment = ''
+        objs = []
+        for fileFragment in self.fileFragments:
+            obj = '$builddir/' + testDir + '/' + fileFragment + '.o'
+            fragment += 'build ' + obj + ': cc ' + testDir + '/' + fileFragment + '.c' \
+                        ' || headers $network_config\n'
+            objs += [obj]
+        fragment += 'build ' + testExe + ': link ' + ' '.join(objs) + ' $lib\n' \
+                    '  map = ' + testMap + '\n'
+        outputs = { testCollection: [testExe] }
+        if self.runTest:
+            outputs['run-' + testCollection] = [testExe]
+        return outputs, fragment
+
+class KVMSymbolsFragmentComposer(builder.BuildSystemFragmentComposer):
+
+    def compose(self, path):
+        obj, fragment = _compile(path, _flags(None, self.includes))
+        return { 'objects': [obj] }, \
+            'build ' + path + ': kvm-symbols rtemsbsd/rtems/generate_kvm_symbols\n' \
+            + fragment
+
+class RPCGENFragmentComposer(builder.BuildSystemFragmentComposer):
+
+    def compose(self, path):
+        headerPath = path[:-2] + '.h'
+        return { 'headers': [headerPath] }, \
+            'build ' + headerPath + ': rpcgen ' + path + '\n'
+
+class RouteKeywordsFragmentComposer(builder.BuildSystemFragmentComposer):
+
+    def compose(self, path):
+        headerPath = path + '.h'
+        return { 'headers': [headerPath] }, \
+            'build ' + headerPath + ': route-keywords ' + path + '\n'
+
+class LexFragmentComposer(builder.BuildSystemFragmentComposer):
+
+    def __init__(self, sym, dep, cflags = None, includes = None):
+        self.sym = sym
+        self.dep = dep
+        self.flags = _flags(cflags, includes)
+
+    def compose(self, path):
+        src = path[:-2] + '.c'
+        dep = path[:path.rfind('/')] + '/' + self.dep
+        fragment = 'build ' + src + ': lex ' + path
+        # Ninja rejects the cycle of a scanner depending on itself
+        if dep != src:
+            fragment += ' | ' + dep
+        fragment += '\n' \
+                    '  sym = ' + self.sym + '\n'
+        obj, objFragment = _compile(src, self.flags)
+        return { 'objects': [obj] }, fragment + objFragment
+
+class YaccFragmentComposer(builder.BuildSystemFragmentComposer):
+
+    def __init__(self, sym, header, cflags = None, includes = None):
+        self.sym = sym
+        self.header = header
+        self.flags = _flags(cflags, includes)
+
+    def compose(self, path):
+        src = path[:-2] + '.c'
+        hdr = path[:path.rfind('/')] + '/' + self.header
+        if self.sym is not None:
+            sym = self.sym
+        else:
+            sym = os.path.basename(src)[:-2]
+        # The yacc outputs of each grammar get their own names so the
+        # grammars can be processed in parallel
+        fragment = 'build ' + src + ' | ' + hdr + ': yacc ' + path + '\n' \
+                   '  sym = ' + sym + '\n' \
+                   '  prefix = ' + path[:-2] + '.yacc\n' \
+                   '  header = ' + hdr + '\n'
+        obj, objFragment = _compile(src, self.flags)
+        return { 'objects': [obj], 'headers': [hdr] }, fragment + objFragment
+
+# Ninja Generator
+class Generator(builder.BuildSystemGenerator):
+    name = 'ninja'
+
+    def restart(self):
+        self.script = ''
+
+    def add(self, line = ''):
+        self.script += line + '\n'
+
+    def write(self):
+        ninja = builder.RTEMS_DIR + '/build.ninja'
+        builder.processDataIfDifferent(self.script, ninja, "build.ninja")
+
+    def setComposers(self):
+        self.composers['source'] = SourceFileFragmentComposer
+        self.composers['test'] = TestFragementComposer
+        self.composers['kvm-symbols'] = KVMSymbolsFragmentComposer
+        self.composers['rpc-gen'] = RPCGENFragmentComposer
+        self.composers['route-keywords'] = RouteKeywordsFragmentComposer
+        self.composers['lex'] = LexFragmentComposer
+        self.composers['yacc'] = YaccFragmentComposer
+
+    def generate(self):
+
+        def _insert(parts, variant, frag):
+            #
+            # The default handler returns an empty string. Skip it.
+            #
+            if type(frag) is not str:
+                outputs, fragment = frag
+                part = parts.setdefault(variant, { 'ninja': '' })
+                part['ninja'] += fragment
+                for group in outputs:
+                    part.setdefault(group, [])
+                    part[group] += outputs[group]
+
+        def _list(lhs, files):
+            if len(files) == 0:
+                self.add(lhs)
+            else:
+                self.add(lhs + ' $')
+                for f in files[:-1]:
+                    self.add('    ' + f + ' $')
+                self.add('    ' + files[-1])
+
+        def _collect(group):
+            files = []
+            for variant in parts:
+                files += parts[variant].get(group, [])
+            return files
+
+        #
+        # Ninja has no conditionals so the files of the modules conditional on
+        # a make variable are not built.
+        #
+        parts = { }
+        for mn in self.getModules():
+            m = self[mn]
+            if m.conditionalOn != "none":
+                continue
+            for f in m.files:
+                _insert(parts, None, f.getFragment(self))
+            for cpu, files in sorted(m.cpuDependentSourceFiles.items()):
+                for f in files:
+                    _insert(parts, cpu, f.getFragment(self))
+        common = parts.setdefault(None, { 'ninja': '' })
+        cpus = sorted([cpu for cpu in parts if cpu is not None])
+
+        self.restart()
+
+        self.add('#')
+        self.add('# RTEMS Project (https://www.rtems.org)')
+        self.add('#')
+        self.add('# Generated Ninja build file. Do not edit, run ./freebsd-to-rtems.py -m')
+        self.add('#')
+        self.add('# The BSP and its tools are set in config.ninja.')
+        self.add('#')
+        self.add('')
+        self.add('ninja_required_version = 1.7')
+        self.add('')
+        self.add('builddir = build-ninja')
+        self.add('lex = lex')
+        self.add('yacc = yacc')
+        self.add('rpcgen = rpcgen')
+        self.add('warnings = %s' % (' '.join(builder.common_no_warnings())))
+        self.add('all_warnings = %s' % (' '.join(builder.common_warnings())))
+        self.add('ldflags =')
+        self.add('test_runner =')
+        self.add('net_tap_interface =')
+        self.add('')
+        self.add('include config.ninja')
+        self.add('')
+        self.add('common_flags = %s -DHAVE_RTEMS_PCI_H=1 $warnings' % \
+                 (' '.join(builder.common_flags())))
+        self.add('cflags = $common_flags %s' % (' '.join(builder.cflags())))
+        self.add('cxxflags = $common_flags %s' % (' '.join(builder.cxxflags())))
+        includes = [i.replace('@CPU@', '$rtems_cpu') for i in builder.cpu_includes()]
+        _list('includes =', includes + builder.includes())
+        self.add('cpu_flags = $builddir/$rtems_cpu.flags')
+        self.add('lib = $builddir/$rtems_cpu/libbsd.a')
+        self.add('common_lib = $builddir/libbsd-common.a')
+        self.add('network_config = testsuite/include/rtems/bsd/test/network-config.h')
+        self.add('')
+        self.add('rule cc')
+        self.add('  command = $cc $bsp_flags $cflags $includes @$cpu_flags $flags ' + \
+                 '-MD -MF $out.d -c $in -o $out')
+        self.add('  depfile = $out.d')
+        self.add('  deps = gcc')
+        self.add('  description = CC $out')
+        self.add('')
+        self.add('rule cxx')
+        self.add('  command = $cxx $bsp_flags $cxxflags $includes @$cpu_flags $flags ' + \
+                 '-MD -MF $out.d -c $in -o $out')
+        self.add('  depfile = $out.d')
+        self.add('  deps = gcc')
+        self.add('  description = CXX $out')
+        self.add('')
+        self.add('rule ar')
+        self.add('  command = rm -f $out && $ar rcs $out $in')
+        self.add('  description = AR $out')
+        self.add('')
+        self.add('rule ar-cpu')
+        self.add('  command = rm -f $out && cp $common_lib $out && $ar rcs $out $in')
+        self.add('  description = AR $out')
+        self.add('')
+        self.add('rule link')
+        self.add('  command = $cc $bsp_flags $cflags $ldflags -Wl,-Map,$map $in -lm -lz -o $out')
+        self.add('  description = LINK $out')
+        self.add('')
+        #
+        # The dummy PIC IRQ support depends on the CPU of the BSP which is
+        # only known to Ninja, so the include path is passed in a file.
+        #
+        self.add('rule cpu-flags')
+        self.add('  command = case $rtems_cpu in ' + \
+                 'arm|i386|lm32|mips|powerpc|sparc|m68k) : > $out ;; ' + \
+                 '*) echo -Irtems-dummy-pic-irq/include > $out ;; esac')
+        self.add('  description = FLAGS $out')
+        self.add('')
+        self.add('rule lex')
+        self.add('  command = $lex -P $sym -t $in | sed -e \'/YY_BUF_SIZE/s/16384/1024/\' > $out')
+        self.add('  description = LEX $out')
+        self.add('')
+        self.add('rule yacc')
+        self.add('  command = $yacc -b $prefix -d -p $sym $in && ' + \
+                 'sed -e \'/YY_BUF_SIZE/s/16384/1024/\' < $prefix.tab.c > $out && ' + \
+                 'rm -f $prefix.tab.c && mv $prefix.tab.h $header')
+        self.add('  description = YACC $out')
+        self.add('')
+        self.add('rule rpcgen')
+        self.add('  command = rm -f $out && $rpcgen -h -o $out $in')
+        self.add('  description = RPCGEN $out')
+        self.add('')
+        self.add('rule route-keywords')
+        self.add('  command = sed -e \'/^#/d\' -e \'/^$$/d\' $in > $out.tmp && ' + \
+                 'LC_ALL=C tr \'a-z\' \'A-Z\' < $out.tmp | paste $out.tmp - | ' + \
+                 'awk \'{ if (NF > 1) printf "#define\\tK_%s\\t%d\\n\\t{\\"%s\\", K_%s},\\n", ' + \
+                 '$$2, NR, $$1, $$2 }\' > $out && rm -f $out.tmp')
+        self.add('  description = KEYWORDS $out')
+        self.add('')
+        self.add('rule kvm-symbols')
+        self.add('  command = ./$in > $out')
+        self.add('  description = KVM $out')
+        self.add('')
+        self.add('rule network-config')
+        self.add('  command = sed -e \'s/@NET_CFG_SELF_IP@/$net_cfg_self_ip/\' ' + \
+                 '-e \'s/@NET_CFG_NETMASK@/$net_cfg_netmask/\' ' + \
+                 '-e \'s/@NET_CFG_PEER_IP@/$net_cfg_peer_ip/\' ' + \
+                 '-e \'s/@NET_CFG_GATEWAY_IP@/$net_cfg_gateway_ip/\' < $in > $out')
+        self.add('  description = SED $out')
+        self.add('')
+        self.add('rule run-tests')
+        self.add('  command = $test_runner $in')
+        self.add('  pool = console')
+        self.add('')
+        self.add('rule run-net-tests')
+        self.add('  command = $test_runner -N -T $net_tap_interface $in')
+        self.add('  pool = console')
+        self.add('')
+        self.add('build $cpu_flags: cpu-flags')
+        self.add('build $network_config: network-config $network_config.in | config.ninja')
+        _list('build headers: phony $cpu_flags', sorted(_collect('headers')))
+        self.add('')
+
+        self.add('# Common objects')
+        self.add('objdir = $builddir')
+        self.script += common['ninja']
+        self.add('build $objdir/rtemsbsd/rtems/rtems-bsd-cxx.o: cxx rtemsbsd/rtems/rtems-bsd-cxx.cc || headers')
+        _list('build $common_lib: ar', common.get('objects', []) + \
+              ['$objdir/rtemsbsd/rtems/rtems-bsd-cxx.o'])
+        self.add('')
+
+        #
+        # Each CPU gets its own library made of the common library and its
+        # CPU specific objects. The CPU of config.ninja selects the library,
+        # so every RTEMS CPU needs one even without CPU specific objects.
+        #
+        for cpu in sorted(set(cpus + builder.rtems_cpus())):
+            part = parts.get(cpu, { 'ninja': '' })
+            self.add('# CPU %s' % (cpu))
+            self.add('objdir = $builddir/%s' % (cpu))
+            self.script += part['ninja']
+            _list('build $objdir/libbsd.a: ar-cpu',
+                  part.get('objects', []) + ['| $common_lib'])
+            self.add('')
+
+        self.add('# Targets')
+        for group in ['tests', 'net-tests', 'run-tests', 'run-net-tests']:
+            rule = 'phony'
+            if group.startswith('run-'):
+                rule = group
+            _list('build %s: %s' % (group, rule), sorted(common.get(group, [])))
+        self.add('')
+        self.add('build libbsd: phony $lib')
+        self.add('default libbsd tests net-tests $network_config')
+
+        self.write()
@@ -33,7 +33,6 @@
 #  OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import os
-import tempfile
 
 import builder
 
@@ -62,10 +61,35 @@ def _clfags_includes(cflags, includes):
         _includes = includes
     return _cflags, _includes
 
+#
+# Canonical flags: empty flags and repeated flags are removed and the flags
+# are sorted if they are all defines. The order of the includes is kept.
+#
+def _canonical_cflags(cflags):
+    if None in cflags:
+        return cflags
+    flags = []
+    for f in cflags:
+        if len(f) > 0 and f not in flags:
+            flags += [f]
+    if len([f for f in flags if not f.startswith('-D')]) == 0:
+        flags = sorted(flags)
+    return flags
+
+def _canonical_includes(includes):
+    _includes = []
+    for i in includes:
+        if i not in _includes:
+            _includes += [i]
+    return _includes
+
 class SourceFileFragmentComposer(builder.BuildSystemFragmentComposer):
 
     def __init__(self, cflags = "default", includes = None):
-        self.cflags, self.includes = _clfags_includes(cflags, includes)
+        cflags, includes = _clfags_includes(cflags, includes)
+        self.declared = ' '.join([str(f) for f in cflags + includes])
+        self.cflags = _canonical_cflags(cflags)
+        self.includes = _canonical_includes(includes)
 
     def compose(self, path):
         if None in self.includes:
@@ -134,8 +158,9 @@ class YaccFragmentComposer(builder.BuildSystemFragmentComposer):
             d['includes'] = self.includes
         return ['yacc', path], d
 
-# Module Manager - Collection of Modules
-class ModuleManager(builder.ModuleManager):
+# Waf Generator
+class Generator(builder.BuildSystemGenerator):
+    name = 'waf'
 
     def restart(self):
         self.script = ''
@@ -144,37 +169,17 @@ class ModuleManager(builder.ModuleManager):
         self.script += line + os.linesep
 
     def write(self):
-        try:
-            out = tempfile.NamedTemporaryFile(delete = False)
-            out.write(self.script)
-            out.close()
-            wscript = builder.RTEMS_DIR + '/wscript'
-            builder.processIfDifferent(out.name, wscript, "wscript")
-        finally:
-            try:
-                os.remove(out.name)
-            except:
-                pass
-
-    def setGenerators(self):
-        self.generator['convert'] = builder.Converter
-        self.generator['no-convert'] = builder.NoConverter
-
-        self.generator['file'] = builder.File
-
-        self.generator['path'] = builder.PathComposer
-        self.generator['freebsd-path'] = builder.FreeBSDPathComposer
-        self.generator['rtems-path'] = builder.RTEMSPathComposer
-        self.generator['cpu-path'] = builder.CPUDependentPathComposer
-        self.generator['target-src-cpu--path'] = builder.TargetSourceCPUDependentPathComposer
-
-        self.generator['source'] = SourceFileFragmentComposer
-        self.generator['test'] = TestFragementComposer
-        self.generator['kvm-symbols'] = KVMSymbolsFragmentComposer
-        self.generator['rpc-gen'] = RPCGENFragmentComposer
-        self.generator['route-keywords'] = RouteKeywordsFragmentComposer
-        self.generator['lex'] = LexFragmentComposer
-        self.generator['yacc'] = YaccFragmentComposer
+        wscript = builder.RTEMS_DIR + '/wscript'
+        builder.processDataIfDifferent(self.script, wscript, "wscript")
+
+    def setComposers(self):
+        self.composers['source'] = SourceFileFragmentComposer
+        self.composers['test'] = TestFragementComposer
+        self.composers['kvm-symbols'] = KVMSymbolsFragmentComposer
+        self.composers['rpc-gen'] = RPCGENFragmentComposer
+        self.composers['route-keywords'] = RouteKeywordsFragmentComposer
+        self.composers['lex'] = LexFragmentComposer
+        self.composers['yacc'] = YaccFragmentComposer
 
     def generate(self):
 
@@ -186,7 +191,9 @@ class ModuleManager(builder.ModuleManager):
                 adder = ''
                 adder_space = ''
             ll = len(lhs)
-            if len(files) == 1:
+            if len(files) == 0:
+                self.add('%s %s= []' % (lhs, adder))
+            elif len(files) == 1:
                 self.add('%s %s= [%r]' % (lhs, adder, files[0]))
             elif len(files) == 2:
                 self.add('%s %s= [%r,' % (lhs, adder, files[0]))
@@ -232,16 +239,37 @@ class ModuleManager(builder.ModuleManager):
                         d['includes'] = []
                     d['includes'] += frag[-1]
 
+        def _group_insert(groups, composer):
+            if isinstance(composer, SourceFileFragmentComposer):
+                group = ' '.join(composer.compose('')[0][1])
+                groups.setdefault(group, set()).add(composer.declared)
+
+        def _module_use(module_use, path, target):
+            module_use.setdefault(owners[path], []).append(target)
+
         data = { }
+        groups = { }
+        owners = { }
+        module_use = { }
+        module_source = { }
 
         for mn in self.getModules():
             m = self[mn]
             if m.conditionalOn == "none":
                 for f in m.files:
-                    _data_insert(data, 'all', f.getFragment())
+                    _data_insert(data, 'all', f.getFragment(self))
+                    _group_insert(groups, f.getComposer(self))
+                    owners[f.pathComposer.composeRTEMSPath(f.path, '')] = mn
             for cpu, files in sorted(m.cpuDependentSourceFiles.items()):
                 for f in files:
-                    _data_insert(data, cpu, f.getFragment())
+                    _data_insert(data, cpu, f.getFragment(self))
+                    _group_insert(groups, f.getComposer(self))
+                    owners[f.pathComposer.composeRTEMSPath(f.path, '')] = mn
+
+        if builder.isVerbose:
+            merged = sum([len(declared) - 1 for declared in groups.values()])
+            print 'waf: %d object group(s), %d merged by canonical flags' % \
+                (len(groups), merged)
 
         if trace:
             import pprint
@@ -281,6 +309,11 @@ class ModuleManager(builder.ModuleManager):
         self.add('                   default = False,')
         self.add('                   dest = "warnings",')
         self.add('                   help = "Enable all warnings. The default is quiet builds.")')
+        self.add('    opt.add_option("--enable-module-libs",')
+        self.add('                   action = "store_true",')
+        self.add('                   default = False,')
+        self.add('                   dest = "module_libs",')
+        self.add('                   help = "Build a library for each module and libbsd.a as a thin archive of them.")')
         self.add('    opt.add_option("--net-test-config",')
         self.add('                   default = "config.inc",')
         self.add('                   dest = "net_config",')
@@ -301,6 +334,7 @@ class ModuleManager(builder.ModuleManager):
         self.add('        conf.find_program("yacc", mandatory = True)')
         self.add('    conf.env.AUTO_REGEN = conf.options.auto_regen')
         self.add('    conf.env.WARNINGS = conf.options.warnings')
+        self.add('    conf.env.MODULE_LIBS = conf.options.module_libs')
         self.add('    conf.env.NET_CONFIG = conf.options.net_config')
         self.add('    rtems.configure(conf, bsp_configure)')
         self.add('')
@@ -401,6 +435,7 @@ class ModuleManager(builder.ModuleManager):
             self.add('                includes = %r + includes,' % (includes))
             self.add('                source = "%s")' % (kvmsymbols['files']['all'][0]))
             self.add('    libbsd_use += ["kvmsymbols"]')
+            _module_use(module_use, kvmsymbols['files']['all'][0], 'kvmsymbols')
             self.add('')
 
         self.add('    bld.add_group()')
@@ -432,7 +467,7 @@ class ModuleManager(builder.ModuleManager):
         if 'lex' in data:
             lexes = data['lex']
             self.add('    # Lex')
-            for l in lexes:
+            for l in sorted(lexes):
                 lex = lexes[l]['all']
                 if 'cflags' in lex:
                     lex_defines = [d[2:] for d in lex['cflags']]
@@ -454,12 +489,13 @@ class ModuleManager(builder.ModuleManager):
                 self.add('                defines = %r,' % (lex_defines))
                 self.add('                source = "%s.c")' % (lex['file'][:-2]))
                 self.add('    libbsd_use += ["lex_%s"]' % (lex['sym']))
+                _module_use(module_use, lex['file'], 'lex_%s' % (lex['sym']))
                 self.add('')
 
         if 'yacc' in data:
             yaccs = data['yacc']
             self.add('    # Yacc')
-            for y in yaccs:
+            for y in sorted(yaccs):
                 yacc = yaccs[y]['all']
                 yacc_file = yacc['file']
                 if yacc['sym'] is not None:
@@ -488,68 +524,114 @@ class ModuleManager(builder.ModuleManager):
                 self.add('                defines = %r,' % (yacc_defines))
                 self.add('                source = "%s.c")' % (yacc_file[:-2]))
                 self.add('    libbsd_use += ["yacc_%s"]' % (yacc_sym))
+                _module_use(module_use, yacc_file, 'yacc_%s' % (yacc_sym))
             self.add('')
 
         #
         # We have 'm' different sets of flags and there can be 'n' cpus
-        # specific files for those flags.
+        # specific files for those flags. The files of a set are listed by
+        # module. The objects of a set are built together unless each module
+        # has a library of its own. We hold the 'default' cflags set of files
+        # to the end to create the static libraries with.
         #
-        objs = 0
-        self.add('    # Objects built with different CFLAGS')
+        objs = []
+        self.add('    # Sources built with different CFLAGS')
         for flags in sorted(data['sources']):
-            if flags is not 'default':
-                objs += 1
-                _source_list('    objs%02d_source' % objs, sorted(data['sources'][flags]['all']))
-                archs = sorted(data['sources'][flags])
-                for arch in archs:
-                    if arch not in ['all', 'cflags', 'includes']:
+            sources = { }
+            for arch in data['sources'][flags]:
+                if arch not in ['cflags', 'includes']:
+                    for f in data['sources'][flags][arch]:
+                        sources.setdefault(owners[f], {}).setdefault(arch, []).append(f)
+            if flags != 'default' and 'cflags' in data['sources'][flags]:
+                defines = [d[2:] for d in data['sources'][flags]['cflags']]
+            else:
+                defines = []
+            if 'includes' in data['sources'][flags]:
+                includes = data['sources'][flags]['includes']
+            else:
+                includes = []
+            if flags == 'default':
+                prefix = 'source'
+            else:
+                target = 'objs%02d' % (len(objs) + 1)
+                prefix = target + '_source'
+                objs += [(target, includes, defines, sorted(sources))]
+            for mn in sorted(sources):
+                name = '    %s_%s' % (prefix, mn)
+                _source_list(name, sorted(sources[mn].get('all', [])))
+                for arch in sorted(sources[mn]):
+                    if arch != 'all':
                         self.add('    if bld.get_env()["RTEMS_ARCH"] == "%s":' % arch)
-                        _source_list('        objs%02d_source' % objs,
-                                     sorted(data['sources'][flags][arch]),
-                                     append = True)
-                if 'cflags' in data['sources'][flags]:
-                    defines = [d[2:] for d in data['sources'][flags]['cflags']]
-                else:
-                    defines = []
-                if 'includes' in data['sources'][flags]:
-                    includes = data['sources'][flags]['includes']
-                else:
-                    includes = []
-                self.add('    bld.objects(target = "objs%02d",' % (objs))
-                self.add('                features = "c",')
-                self.add('                cflags = cflags,')
-                self.add('                includes = %r + includes,' % (includes))
-                self.add('                defines = %r,' % (defines))
-                self.add('                source = objs%02d_source)' % objs)
-                self.add('    libbsd_use += ["objs%02d"]' % (objs))
-                self.add('')
+                        _source_list('    ' + name, sorted(sources[mn][arch]), append = True)
+                if flags == 'default':
+                    module_source[mn] = '%s_%s' % (prefix, mn)
+        self.add('')
+
+        self.add('    # Objects built with different CFLAGS')
+        self.add('    if bld.env.MODULE_LIBS:')
+        for target, includes, defines, modules in objs:
+            for mn in modules:
+                self.add('        bld.objects(target = "%s_%s",' % (target, mn))
+                self.add('                    features = "c",')
+                self.add('                    cflags = cflags,')
+                self.add('                    includes = %r + includes,' % (includes))
+                self.add('                    defines = %r,' % (defines))
+                self.add('                    source = %s_source_%s)' % (target, mn))
+                module_use.setdefault(mn, []).append('%s_%s' % (target, mn))
+        self.add('    else:')
+        for target, includes, defines, modules in objs:
+            self.add('        bld.objects(target = "%s",' % (target))
+            self.add('                    features = "c",')
+            self.add('                    cflags = cflags,')
+            self.add('                    includes = %r + includes,' % (includes))
+            self.add('                    defines = %r,' % (defines))
+            self.add('                    source = %s)' % (' + '.join(['%s_source_%s' % (target, mn)
+                                                                   for mn in modules])))
+            self.add('        libbsd_use += ["%s"]' % (target))
+        self.add('')
 
         #
-        # We hold the 'default' cflags set of files to the end to create the
-        # static library with.
+        # The libraries of the modules, the thin libbsd.a refers to them.  The
+        # modules depend on each other in cycles which are not declared, so the
+        # programs link the libraries as a group.
         #
-        _source_list('    source', sorted(data['sources']['default']['all']))
-        archs = sorted(data['sources']['default'])
-        for arch in archs:
-            if arch is not 'all':
-                self.add('    if bld.get_env()["RTEMS_ARCH"] == "%s":' % arch)
-                _source_list('        source',
-                             sorted(data['sources']['default'][arch]),
-                             append = True)
-        self.add('    bld.stlib(target = "bsd",')
-        self.add('              features = "c cxx",')
-        self.add('              cflags = cflags,')
-        self.add('              cxxflags = cxxflags,')
-        self.add('              includes = includes,')
-        self.add('              source = source,')
-        self.add('              use = libbsd_use)')
+        self.add('    # Libraries')
+        self.add('    if bld.env.MODULE_LIBS:')
+        self.add('        bld.env.append_value("STLIB_MARKER", ["-Wl,--start-group"])')
+        self.add('        bld.env.prepend_value("SHLIB_MARKER", ["-Wl,--end-group"])')
+        libs = [mn for mn in self.mm.getLinkOrder() if mn in module_use or mn in module_source]
+        for mn in libs:
+            self.add('        bld.stlib(target = "bsd-%s",' % (mn))
+            self.add('                  features = "c cstlib",')
+            self.add('                  cflags = cflags,')
+            self.add('                  includes = includes,')
+            self.add('                  source = %s,' % (module_source.get(mn, '[]')))
+            self.add('                  use = %r)' % (module_use.get(mn, [])))
+        _source_list('        libbsd', ['bsd-%s' % (mn) for mn in libs])
+        self.add('        bld(target = "libbsd.a",')
+        self.add('            source = ["lib%s.a" % (l) for l in libbsd],')
+        self.add('            rule = "${AR} rcT ${TGT} ${SRC}")')
+        self.add('        libbsd_files = ["libbsd.a"] + ["lib%s.a" % (l) for l in libbsd]')
+        self.add('    else:')
+        self.add('        source = []')
+        for mn in sorted(module_source):
+            self.add('        source += %s' % (module_source[mn]))
+        self.add('        bld.stlib(target = "bsd",')
+        self.add('                  features = "c cxx",')
+        self.add('                  cflags = cflags,')
+        self.add('                  cxxflags = cxxflags,')
+        self.add('                  includes = includes,')
+        self.add('                  source = source,')
+        self.add('                  use = libbsd_use)')
+        self.add('        libbsd = ["bsd"]')
+        self.add('        libbsd_files = ["libbsd.a"]')
         self.add('')
 
         #
         # Head file collector.
         #
         self.add('    # Installs.    ')
-        self.add('    bld.install_files("${PREFIX}/" + rtems.arch_bsp_lib_path(bld.env.RTEMS_ARCH_BSP), ["libbsd.a"])')
+        self.add('    bld.install_files("${PREFIX}/" + rtems.arch_bsp_lib_path(bld.env.RTEMS_ARCH_BSP), libbsd_files)')
         header_paths = builder.header_paths()
         self.add('    header_paths = [%s,' % (str(header_paths[0])))
         for hp in header_paths[1:-1]:
@@ -566,7 +648,7 @@ class ModuleManager(builder.ModuleManager):
 
         self.add('    # Tests')
         tests = data['tests']
-        for test_name in tests:
+        for test_name in sorted(tests):
             files = ['testsuite/%s/%s.c' % (test_name, f) for f in  data['tests'][test_name]['all']['files']]
             _source_list('    test_%s' % (test_name), sorted(files))
             self.add('    bld.program(target = "%s",' % (test_name))
@@ -574,7 +656,7 @@ class ModuleManager(builder.ModuleManager):
             self.add('                cflags = cflags,')
             self.add('                includes = includes,')
             self.add('                source = test_%s,' % (test_name))
-            self.add('                use = ["bsd"],')
+            self.add('                use = libbsd,')
             self.add('                lib = ["m", "z"],')
             self.add('                install_path = None)')
             self.add('')